@@ -1,11 +1,13 @@
 from time import time
-from get_new_podcast import get_all_new_podcast
+from get_new_podcast import get_all_new_podcast, prefetch_new_podcast
+from itertools import chain
 from datetime import datetime, timedelta
 from db_manager import DatabaseManager
-from files_manager import FilesManager
 from logging_manager import loger
-from create_email_message import create_mail_message
-from send_email import send_email
+from lease_manager import LeaseHeartbeat, WORKER_ID, LEASE_TTL
+from run_deadline import RunDeadline
+import run_profiler
+import sys
 import traceback
 
 
@@ -16,35 +18,77 @@ def main():
 
     loger.info('start running!')
 
+    # After the run deadline no new feed or episode is started, so a slow run doesn't overlap the next one
+    deadline = RunDeadline()
+
     # Create db manager instance
     start_db_time = time()
     db = DatabaseManager()
     loger.debug(f'init db in: {(time() - start_db_time):.1f} seconds')
 
-    # Get the new podcast from RSS
+    # Keep the feed and episode leases of this worker alive until the process ends
+    LeaseHeartbeat(db).start()
+
+    # Get the new podcast from RSS, the discovery keeps running in the background during the transfer
     yesterday = (datetime.now() - timedelta(days=1)).date()
     start_check_time = time()
-    new_podcast = get_all_new_podcast(db, yesterday)
-    loger.info(f'got {len(new_podcast)} new podcast, in {(time() - start_check_time):.1f} seconds')
+    discovery = get_all_new_podcast(db, yesterday, deadline=deadline)
+    new_podcast = prefetch_new_podcast(run_profiler.profiled_iter('discovery', discovery))
+    first_podcast = next(new_podcast, None)
 
     # If no new podcast receives exit without sending email
-    if len(new_podcast) == 0:
+    if first_podcast is None:
         loger.info('no newz found! exit with out sending email')
         exit()
+    loger.info(f'got first new podcast in {(time() - start_check_time):.1f} seconds')
+
+    # Heavy subsystems are imported only when their stage runs, so the common no-newz run
+    # pays only for feedparser and SQLAlchemy
+    from files_manager import FilesManager
 
     # Download the podcast and then upload to googlDrive
-    downloader = FilesManager(new_podcast, db)
-    downloader.get_all_podcast()
+    downloader = FilesManager(chain([first_podcast], new_podcast), db, deadline=deadline)
+    with run_profiler.stage('transfer'):
+        downloader.get_all_podcast()
+    new_podcast.close()
+
+    # Only one worker sends the email, episodes of workers that are still running will be sent by the next run
+    if not db.acquire_lease('send', WORKER_ID, LEASE_TTL):
+        loger.info('email is sent by another worker')
+        return
 
-    # Create the email message and send it to all members
-    podcast_to_send = db.fetch_unsent_podcast_files()
-    email_message = create_mail_message(podcast_to_send)
+    # Create the email messages and send them to the subscribers
+    from digest_planner import plan_digests
+    from send_email import send_email, update_sent_podcast
+    try:
+        podcast_to_send = db.fetch_unsent_podcast_files()
+        if not podcast_to_send:
+            loger.info('all new podcast already sent')
+            return
+
+        # Subscribers with the same shows get the same digest, so each distinct digest is rendered once
+        with run_profiler.stage('render'):
+            digests = plan_digests(db, podcast_to_send)
 
-    send_email(db, email_message, podcast_to_send)
+        # Episodes of shows that no subscriber selected are not sent to anyone, so they are marked as sent
+        # already now, and a subscriber that selects their show later won't get them
+        planned_podcast = {podcast.id for digest in digests for podcast in digest.podcast}
+        update_sent_podcast([podcast for podcast in podcast_to_send if podcast.id not in planned_podcast], db)
+
+        # Each digest is split into messages by size, each message marks only its own episodes as sent.
+        # After a failure the unsent episodes are sent again on the next run, also to the recipients that got them
+        with run_profiler.stage('send'):
+            send_email(db, digests)
+    finally:
+        db.release_lease('send', WORKER_ID)
 
 
 if __name__ == '__main__':
     start_run_time = time()
+
+    # Profile each stage of this run, the output is written next to the log file
+    if run_profiler.PROFILE or '--profile' in sys.argv:
+        run_profiler.start()
     try:
         # Execute all workflows for new podcasts
         main()
@@ -60,5 +104,7 @@ if __name__ == '__main__':
         # Write the run-time into the log file in case the exit() function is used during runtime
         loger.info(f'run time: {timedelta(seconds=(time() - start_run_time))}')
         exit()
+    finally:
+        run_profiler.stop()
     # Write the run-time into the log file
     loger.info(f'run time: {timedelta(seconds=(time()-start_run_time))}')
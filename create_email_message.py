@@ -1,12 +1,195 @@
+import glob
+import hashlib
+import os
+from email.generator import BytesGenerator
 from email.mime.image import MIMEImage
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
+from functools import lru_cache
 from time import strftime, gmtime
-from typing import List, Type
+from typing import List, Type, Iterator, Tuple, BinaryIO
 from premailer import transform
 from db_schema import PodcastFiles
 from jinja2 import Template
 
+# Maximum size in bytes of one email message, a bigger digest is split into several messages
+MAX_MESSAGE_BYTES = int(os.environ.get('PODCAST_EMAIL_MAX_BYTES', 10 * 1024 ** 2))
+
+# Maximum number of podcast episodes in one email message
+MAX_MESSAGE_EPISODES = int(os.environ.get('PODCAST_EMAIL_MAX_EPISODES', 30))
+
+# Directory of the cached inlined podcast boxes, the file name is <podcast file id>-<templates hash>.html
+FRAGMENTS_CACHE_DIR = 'cache/fragments'
+
+PODCAST_TEMPLATE = 'templates/podcast_template.html'
+MESSAGE_TEMPLATE = 'templates/message_template.html'
+
+# Marks of the boxes area in the message template, HTML comments are kept by premailer
+BOXES_START = '<!--boxes-start-->'
+BOXES_END = '<!--boxes-end-->'
+
+
+class _ByteCounter:
+    """
+    Binary file-like object that only counts the written bytes.
+    """
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data: bytes) -> None:
+        self.size += len(data)
+
+
+def write_message(message: MIMEMultipart, fp: BinaryIO) -> None:
+    """
+    Serialize an email message with CRLF line endings into a binary file-like object,
+    part by part, without creating the whole message as one string.
+
+    Parameters:
+        message (MIMEMultipart): The email message.
+        fp (BinaryIO): Object with a write(bytes) method, like a file or a socket stream.
+    """
+    BytesGenerator(fp, mangle_from_=False, policy=message.policy.clone(linesep='\r\n')).flatten(message)
+
+
+def message_size(message: MIMEMultipart) -> int:
+    """
+    Calculate the size in bytes of the serialized email message.
+
+    Parameters:
+        message (MIMEMultipart): The email message.
+
+    Returns:
+        int: The message size in bytes.
+    """
+    counter = _ByteCounter()
+    write_message(message, counter)
+    return counter.size
+
+
+def _encoded_size(data_size: int) -> int:
+    """
+    Calculate the size of data after base64 encoding with 76 characters lines.
+
+    Parameters:
+        data_size (int): Size of the raw data in bytes.
+
+    Returns:
+        int: The encoded size in bytes.
+    """
+    encoded_size = -(-data_size // 3) * 4
+    return encoded_size + encoded_size // 76 * 2
+
+
+@lru_cache(maxsize=None)
+def _read_template(template_path: str) -> str:
+    with open(template_path, 'r', encoding='utf-8') as f:
+        return f.read()
+
+
+@lru_cache(maxsize=None)
+def _templates_hash() -> str:
+    """
+    Hash of the podcast box and message templates, so cached fragments of old templates are not used.
+
+    Returns:
+        str: md5 hex digest of the templates.
+    """
+    templates_hash = hashlib.md5()
+    for template_path in (PODCAST_TEMPLATE, MESSAGE_TEMPLATE):
+        templates_hash.update(_read_template(template_path).encode('utf-8'))
+    return templates_hash.hexdigest()
+
+
+def _render_message(all_boxes: str) -> str:
+    return Template(_read_template(MESSAGE_TEMPLATE)).render(all_boxes=all_boxes, logo_link='cid:logo.jpg',
+                                                             subscribe_link='', unsubscribe_link='')
+
+
+def _inline_boxes(all_boxes: str) -> str:
+    """
+    Inline the message template CSS into podcast boxes, exactly as when inlining the whole message.
+
+    Parameters:
+        all_boxes (str): HTML of podcast boxes.
+
+    Returns:
+        str: The HTML of the boxes with inline styles.
+    """
+    inlined_message = transform(_render_message(f'{BOXES_START}{all_boxes}{BOXES_END}'))
+    return inlined_message.split(BOXES_START, 1)[1].split(BOXES_END, 1)[0]
+
+
+@lru_cache(maxsize=None)
+def _inlined_message_template() -> Tuple[str, str]:
+    """
+    The message template with inline styles, split around the boxes area.
+
+    Returns:
+        tuple[str, str]: The HTML before and after the podcast boxes.
+    """
+    inlined_message = transform(_render_message(f'{BOXES_START}{BOXES_END}'))
+    before, after = inlined_message.split(f'{BOXES_START}{BOXES_END}', 1)
+    return before, after
+
+
+def _fragment_path(podcast: Type[PodcastFiles]) -> str:
+    return os.path.join(FRAGMENTS_CACHE_DIR, f'{podcast.id}-{_templates_hash()}.html')
+
+
+def cache_podcast_fragment(podcast: Type[PodcastFiles]) -> str:
+    """
+    Render the podcast box, inline its styles and store it in the fragments cache.
+    Called once when the podcast file is recorded, so the digest only concatenates the cached fragments.
+
+    Parameters:
+        podcast (PodcastFiles): The recorded podcast file, with its podcast class details.
+
+    Returns:
+        str: The inlined HTML fragment of the podcast box.
+    """
+    fragment = _inline_boxes(_create_podcast_box(podcast))
+    os.makedirs(FRAGMENTS_CACHE_DIR, exist_ok=True)
+    fragment_path = _fragment_path(podcast)
+    temporary_path = f'{fragment_path}.{os.getpid()}.tmp'
+    with open(temporary_path, 'w', encoding='utf-8') as f:
+        f.write(fragment)
+    os.replace(temporary_path, fragment_path)
+    return fragment
+
+
+def get_podcast_fragment(podcast: Type[PodcastFiles]) -> str:
+    """
+    Get the inlined HTML fragment of the podcast box from the cache, render and cache it if missing
+    (like a file recorded by another host or with older templates).
+
+    Parameters:
+        podcast (PodcastFiles): The podcast file.
+
+    Returns:
+        str: The inlined HTML fragment of the podcast box.
+    """
+    try:
+        with open(_fragment_path(podcast), 'r', encoding='utf-8') as f:
+            return f.read()
+    except FileNotFoundError:
+        return cache_podcast_fragment(podcast)
+
+
+def discard_podcast_fragments(sent_podcast: List[Type[PodcastFiles]]) -> None:
+    """
+    Delete the cached fragments of podcast files that already sent, also the ones rendered by older templates.
+
+    Parameters:
+        sent_podcast (list[PodcastFiles]): The sent podcast files.
+    """
+    for podcast in sent_podcast:
+        for fragment_path in glob.glob(os.path.join(FRAGMENTS_CACHE_DIR, f'{podcast.id}-*.html')):
+            try:
+                os.remove(fragment_path)
+            except FileNotFoundError:
+                pass
+
 
 def _create_podcast_box(podcast: Type[PodcastFiles]) -> str:
     """
@@ -22,8 +205,7 @@ def _create_podcast_box(podcast: Type[PodcastFiles]) -> str:
     podcast_details = podcast.podcast
 
     # Create template of podcast box from template file
-    with open('templates/podcast_template.html', 'r', encoding='utf-8') as f:
-        podcast_template = Template(f.read())
+    podcast_template = Template(_read_template(PODCAST_TEMPLATE))
 
     # Render the template with podcast details
     podcast_box = podcast_template.render(
@@ -40,53 +222,48 @@ def _create_podcast_box(podcast: Type[PodcastFiles]) -> str:
     return podcast_box
 
 
-def _create_html_message(new_podcast: List[Type[PodcastFiles]]) -> str:
+def _create_html_message(new_podcast: List[Type[PodcastFiles]], podcast_boxes: List[str] = None) -> str:
     """
     Create an HTML message containing podcast boxes for a list of new podcast files to send it as an email message.
+    The message is a concatenation of the inlined message template and the cached inlined podcast boxes.
 
     Parameters:
         new_podcast (list[PodcastFiles]): A list of PodcastFiles objects representing new podcast episodes.
+        podcast_boxes (list[str], optional): The already inlined podcast boxes of new_podcast.
 
     Returns:
-        str: The HTML representation of the email message.
+        str: The HTML representation of the email message, with inline styles.
     """
 
-    # Initialize an empty string to concatenate all podcast boxes
-    all_podcast_boxes = ''
+    # Concatenate all podcast boxes
+    if podcast_boxes is None:
+        podcast_boxes = [get_podcast_fragment(podcast) for podcast in new_podcast]
 
-    # Iterate through each new podcast and create a podcast box
-    for podcast in new_podcast:
-        all_podcast_boxes += _create_podcast_box(podcast)
-
-    # Create message template from template file
-    with open('templates/message_template.html', 'r', encoding='utf-8') as f:
-        message_template = Template(f.read())
+    # Put the boxes in the inlined message template
+    before_boxes, after_boxes = _inlined_message_template()
+    return ''.join([before_boxes, *podcast_boxes, after_boxes])
 
-    # Render the HTML message with all new podcasts and logo area
-    email_message = message_template.render(all_boxes=all_podcast_boxes,
-                                            logo_link='cid:logo.jpg', subscribe_link='', unsubscribe_link='')
-    return email_message
 
-
-def create_mail_message(new_podcast: List[Type[PodcastFiles]]) -> MIMEMultipart:
+def create_mail_message(new_podcast: List[Type[PodcastFiles]], podcast_boxes: List[str] = None) -> MIMEMultipart:
     """
     Create an email message with HTML content and embedded images for a list of new podcast files.
 
     Parameters:
         new_podcast (list[PodcastFiles]): A list of PodcastFiles objects representing new podcast episodes.
+        podcast_boxes (list[str], optional): The already inlined podcast boxes of new_podcast.
 
     Returns:
         MIMEMultipart: An email message with HTML content and embedded images.
     """
 
     # Create the HTML content for the email message
-    html_message = _create_html_message(new_podcast)
+    html_message = _create_html_message(new_podcast, podcast_boxes)
 
     # Create an MIMEMultipart object to represent the email message
     message = MIMEMultipart()
 
     # Attach the HTML to the message
-    message.attach(MIMEText(transform(html_message), 'html'))
+    message.attach(MIMEText(html_message, 'html'))
 
     # Create image objects for each podcast class and attach it to the message
     exist_podcast_id = []
@@ -105,3 +282,75 @@ def create_mail_message(new_podcast: List[Type[PodcastFiles]]) -> MIMEMultipart:
         message.attach(logo)
 
     return message
+
+
+def _split_podcast(new_podcast: List[Type[PodcastFiles]], podcast_boxes: List[str], base_size: int,
+                   max_bytes: int, max_episodes: int) -> List[List[int]]:
+    """
+    Split the podcast episodes into groups by the estimated message size and the episodes count.
+
+    Parameters:
+        new_podcast (list[PodcastFiles]): The new podcast episodes.
+        podcast_boxes (list[str]): The inlined podcast boxes of new_podcast.
+        base_size (int): Estimated size of a message without any episode.
+        max_bytes (int): Maximum size of a message.
+        max_episodes (int): Maximum episodes in a message.
+
+    Returns:
+        list[list[int]]: Groups of the indexes in new_podcast.
+    """
+    groups = []
+    group, group_size, group_images = [], base_size, set()
+    for i, (podcast, podcast_box) in enumerate(zip(new_podcast, podcast_boxes)):
+        box_size = _encoded_size(len(podcast_box.encode('utf-8')))
+        image_size = _encoded_size(len(podcast.podcast.image or b''))
+        size = box_size + (0 if podcast.podcast_id in group_images else image_size)
+        if group and (group_size + size > max_bytes or len(group) >= max_episodes):
+            groups.append(group)
+            group, group_size, group_images = [], base_size, set()
+            size = box_size + image_size
+        group.append(i)
+        group_size += size
+        group_images.add(podcast.podcast_id)
+    if group:
+        groups.append(group)
+    return groups
+
+
+def _create_mail_parts(new_podcast: List[Type[PodcastFiles]], podcast_boxes: List[str],
+                       max_bytes: int) -> Iterator[Tuple[MIMEMultipart, List[Type[PodcastFiles]]]]:
+    """
+    Create the message of a group of episodes, split it again in halves if it's still bigger than max_bytes.
+    """
+    message = create_mail_message(new_podcast, podcast_boxes)
+    if len(new_podcast) > 1 and message_size(message) > max_bytes:
+        middle = len(new_podcast) // 2
+        yield from _create_mail_parts(new_podcast[:middle], podcast_boxes[:middle], max_bytes)
+        yield from _create_mail_parts(new_podcast[middle:], podcast_boxes[middle:], max_bytes)
+    else:
+        yield message, new_podcast
+
+
+def create_mail_messages(new_podcast: List[Type[PodcastFiles]], max_bytes: int = MAX_MESSAGE_BYTES,
+                         max_episodes: int = MAX_MESSAGE_EPISODES
+                         ) -> Iterator[Tuple[MIMEMultipart, List[Type[PodcastFiles]]]]:
+    """
+    Create the email messages for a list of new podcast files, split into several messages so each message
+    is up to max_bytes and max_episodes. Each message embeds only the images of its own episodes.
+
+    Parameters:
+        new_podcast (list[PodcastFiles]): A list of PodcastFiles objects representing new podcast episodes.
+        max_bytes (int): Maximum size in bytes of one message.
+        max_episodes (int): Maximum number of episodes in one message.
+
+    Returns:
+        Iterator[tuple[MIMEMultipart, list[PodcastFiles]]]: Generator of the messages with the episodes of each one.
+    """
+    podcast_boxes = [get_podcast_fragment(podcast) for podcast in new_podcast]
+
+    # The size of a message without episodes: the message template and the logo
+    template_size = sum(len(html.encode('utf-8')) for html in _inlined_message_template())
+    base_size = _encoded_size(template_size) + _encoded_size(os.path.getsize('templates/freenet.png'))
+
+    for group in _split_podcast(new_podcast, podcast_boxes, base_size, max_bytes, max_episodes):
+        yield from _create_mail_parts([new_podcast[i] for i in group], [podcast_boxes[i] for i in group], max_bytes)
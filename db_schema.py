@@ -1,6 +1,6 @@
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
-from sqlalchemy import Column, String, Integer, LargeBinary, DateTime, ForeignKey
+from sqlalchemy import Column, String, Integer, Float, LargeBinary, DateTime, ForeignKey
 
 Base = declarative_base()
 
@@ -20,6 +20,19 @@ class Subscribers(Base):
     email = Column(String, unique=True)
 
 
+class Subscriptions(Base):
+    """
+    Table to store the shows selected by each subscriber, a subscriber without any selection gets all the shows.
+
+    Attributes:
+    - subscriber_id (int): Foreign key referencing the Subscribers table.
+    - rss_id (int): Foreign key referencing the RssPodcast table.
+    """
+    __tablename__ = 'subscriptions'
+    subscriber_id = Column(Integer, ForeignKey('subscribers.id'), primary_key=True)
+    rss_id = Column(Integer, ForeignKey('rss_podcast.id'), primary_key=True)
+
+
 class RssPodcast(Base):
     """
     Table to store information about podcast with RSS links.
@@ -61,7 +74,8 @@ class PodcastFiles(Base):
     - source_link (str): Source link for the podcast file.
     - name (str): Name of the podcast file.
     - description (str): Description of the podcast file.
-    - size (str): Size of the podcast file.
+    - size (str): Size of the podcast file, as uploaded.
+    - original_size (int): Size of the source file before its ID3 tag was stripped (default is None - not stripped).
     - duration (int): Duration in seconds of the podcast file.
     - published_date (DateTime): Date and time when the podcast file was published.
     - is_sent (int): Flag indicating whether the podcast file has been sent (default is 0 - False).
@@ -75,6 +89,45 @@ class PodcastFiles(Base):
     name = Column(String)
     description = Column(String)
     size = Column(String)
+    original_size = Column(Integer, default=None, nullable=True)
     duration = Column(Integer)
     published_date = Column(DateTime)
     is_sent = Column(Integer, default=0)
+
+
+class Leases(Base):
+    """
+    Table to store time-limited leases, so several workers could split the feeds and episodes without overlap.
+
+    Attributes:
+    - resource (str): Primary key, the leased resource (like rss:<id> or episode:<hash>).
+    - owner (str): ID of the worker that holds the lease.
+    - expires_at (DateTime): UTC date and time when the lease expires unless renewed by heartbeat.
+    """
+    __tablename__ = 'leases'
+    resource = Column(String, primary_key=True)
+    owner = Column(String)
+    expires_at = Column(DateTime)
+
+
+class FeedHealth(Base):
+    """
+    Table to store the health of each RSS feed, so feeds that keep failing are probed less often.
+
+    Attributes:
+    - rss_id (int): Primary key, foreign key referencing the RssPodcast table.
+    - consecutive_failures (int): Number of failed fetches since the last successful one.
+    - last_error (str): The error of the last failed fetch.
+    - last_failure (DateTime): UTC date and time of the last failed fetch.
+    - last_success (DateTime): UTC date and time of the last successful fetch.
+    - average_latency (float): Moving average of the fetch time in seconds.
+    - next_probe (DateTime): UTC date and time until the feed is skipped, None if the feed is healthy.
+    """
+    __tablename__ = 'feed_health'
+    rss_id = Column(Integer, ForeignKey('rss_podcast.id'), primary_key=True)
+    consecutive_failures = Column(Integer, default=0)
+    last_error = Column(String, default=None, nullable=True)
+    last_failure = Column(DateTime, default=None, nullable=True)
+    last_success = Column(DateTime, default=None, nullable=True)
+    average_latency = Column(Float, default=None, nullable=True)
+    next_probe = Column(DateTime, default=None, nullable=True)
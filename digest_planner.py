@@ -0,0 +1,46 @@
+from typing import List, Type, NamedTuple
+from db_manager import DatabaseManager
+from db_schema import PodcastFiles
+from logging_manager import loger
+
+
+class Digest(NamedTuple):
+    """
+    One distinct digest, rendered once and sent to all its recipients.
+
+    Attributes:
+    - podcast (list[PodcastFiles]): The episodes of the digest.
+    - recipients (list[str]): Email addresses of the subscribers that get the digest.
+    """
+    podcast: List[Type[PodcastFiles]]
+    recipients: List[str]
+
+
+def plan_digests(db: DatabaseManager, new_podcast: List[Type[PodcastFiles]]) -> List[Digest]:
+    """
+    Group the subscribers by the shows they get from the new episodes, so each distinct digest is rendered once
+    however many subscribers get it.
+    Subscribers whose selected shows differ only by shows without new episodes get the same digest.
+    A subscriber without any selected show gets all the shows.
+
+    Parameters:
+        db (DatabaseManager): Database manager to fetch the subscribers and their selected shows.
+        new_podcast (list[PodcastFiles]): The episodes to send.
+
+    Returns:
+        list[Digest]: The distinct digests, the biggest group first. Subscribers without new episodes are left out.
+    """
+    subscriptions = db.fetch_subscriptions()
+    new_shows = frozenset(podcast.podcast_id for podcast in new_podcast)
+
+    groups = {}
+    for subscriber in db.fetch_subscribers():
+        selected_shows = subscriptions.get(subscriber.id)
+        digest_shows = new_shows if selected_shows is None else new_shows & selected_shows
+        if digest_shows:
+            groups.setdefault(digest_shows, []).append(subscriber.email)
+
+    digests = [Digest([podcast for podcast in new_podcast if podcast.podcast_id in digest_shows], recipients)
+               for digest_shows, recipients in sorted(groups.items(), key=lambda group: -len(group[1]))]
+    loger.info(f'{sum(len(digest.recipients) for digest in digests)} subscribers get {len(digests)} distinct digests')
+    return digests
@@ -0,0 +1,473 @@
+import json
+import os
+import random
+import httplib2
+from threading import Lock, local
+from time import sleep, monotonic
+from typing import Union, Callable, Any, List
+from urllib.parse import urljoin, urlparse, urlunparse
+from google.oauth2 import service_account
+from google_auth_httplib2 import AuthorizedHttp
+from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaFileUpload, BatchHttpRequest
+from logging_manager import loger
+
+# Directory of the Google Drive service accounts credential files
+CREDENTIALS_DIR = 'credentials'
+
+DRIVE_SCOPES = ['https://www.googleapis.com/auth/drive']
+
+# Alternative Drive API endpoint (like a local fake Drive server), e.g. http://127.0.0.1:8080/drive/v3/
+DRIVE_API_ENDPOINT = os.environ.get('PODCAST_DRIVE_API_ENDPOINT')
+
+# Maximum calls in one Drive batch request
+BATCH_LIMIT = 100
+
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+PUBLIC_PERMISSION = {
+    'type': 'anyone',
+    'role': 'reader',
+}
+
+# Timeout in seconds of each Drive API socket operation
+DRIVE_TIMEOUT = float(os.environ.get('PODCAST_DRIVE_TIMEOUT', 120))
+
+# Maximum API requests per second for each service account
+ACCOUNT_QPS = float(os.environ.get('PODCAST_DRIVE_ACCOUNT_QPS', 5))
+
+# Retry policy for rate limit and server errors, the backoff is 1, 2, 4... seconds up to MAX_BACKOFF
+MAX_RETRIES = 6
+MAX_BACKOFF = 32
+RETRY_STATUS = {429, 500, 502, 503, 504}
+RATE_LIMIT_REASONS = {'rateLimitExceeded', 'userRateLimitExceeded'}
+STORAGE_QUOTA_REASONS = {'storageQuotaExceeded', 'quotaExceeded'}
+
+# Upload chunk size limits, the chunk size must be a multiple of 256 KB
+CHUNK_UNIT = 256 * 1024
+MIN_CHUNK_SIZE = 8 * 1024 ** 2
+MAX_CHUNK_SIZE = 64 * 1024 ** 2
+
+
+class DriveAccountExhausted(Exception):
+    """
+    Raised when a service account runs out of storage in the middle of an upload.
+    """
+
+
+def _chunk_size(file_size: int) -> int:
+    """
+    Choose the resumable upload chunk size by the file size:
+    about 4 chunks per file, so a failed chunk doesn't resend the whole file,
+    but not too small chunks that cost an extra round-trip for each few MB.
+    :param file_size: The file size in bytes
+    :return: chunk size in bytes, a multiple of 256 KB
+    """
+    chunk_size = -(-file_size // 4 // CHUNK_UNIT) * CHUNK_UNIT
+    return min(max(chunk_size, MIN_CHUNK_SIZE), MAX_CHUNK_SIZE)
+
+
+def _error_reason(error: HttpError) -> str:
+    """
+    Extract the Drive error reason (like rateLimitExceeded) from an HttpError
+    :param error: The HttpError raised by the API request
+    :return: the reason string, empty string if not found
+    """
+    try:
+        return json.loads(error.content)['error']['errors'][0]['reason']
+    except (ValueError, KeyError, IndexError, TypeError):
+        return ''
+
+
+def _drive_link(file_id: str) -> str:
+    return f'https://drive.google.com/file/d/{file_id}/view'
+
+
+class _CountingHttp(httplib2.Http):
+    """
+    httplib2.Http that counts the HTTP round-trips of an account.
+    """
+    def __init__(self, account: 'DriveAccount'):
+        super().__init__(timeout=DRIVE_TIMEOUT)
+        self._account = account
+
+    def request(self, uri, *args, **kwargs):
+        self._account.count_round_trip()
+        if DRIVE_API_ENDPOINT:
+            # googleapiclient keeps the https scheme of the media upload URL, use the endpoint scheme instead
+            endpoint = urlparse(DRIVE_API_ENDPOINT)
+            parsed_uri = urlparse(uri)
+            if parsed_uri.netloc == endpoint.netloc:
+                uri = urlunparse(parsed_uri._replace(scheme=endpoint.scheme))
+        return super().request(uri, *args, **kwargs)
+
+
+class DriveAccount:
+    """
+    A Google Drive service account with its free space and current load.
+
+    Attributes:
+    - cred_path (str): Path to the JSON file containing the service account credentials.
+    - free_space (int): Free space in bytes, excluding the reserved space of in-flight uploads.
+    - in_flight (int): Number of uploads running on the account.
+    - exhausted (bool): True if the account ran out of storage during this run.
+    - round_trips (int): Number of HTTP requests sent to the Drive API by the account.
+    - folders (dict[str, str]): Cache of folder name to folder ID.
+    - pending_permissions (list[str]): IDs of uploaded files waiting for the batched public permission.
+    """
+    def __init__(self, cred_path: str, free_space: int = 0, qps: float = ACCOUNT_QPS):
+        """
+        Init the account.
+        :param cred_path: Path to the JSON file containing the service account credentials
+        :param free_space: Free space of the account in bytes
+        :param qps: Maximum API requests per second for the account
+        """
+        self.cred_path = cred_path
+        self.free_space = free_space
+        self.in_flight = 0
+        self.exhausted = False
+        self.round_trips = 0
+        self.folders = {}
+        self.pending_permissions = []
+        self.lock = Lock()
+        self._interval = 1 / qps
+        self._next_request_time = 0.0
+        self._throttle_lock = Lock()
+        self._local = local()
+
+    def _credentials(self):
+        return service_account.Credentials.from_service_account_file(self.cred_path, scopes=DRIVE_SCOPES)
+
+    def service(self):
+        """
+        Get a Drive service of the account, one for each thread since httplib2 is not thread safe
+        :return: Drive v3 service resource
+        """
+        if not hasattr(self._local, 'service'):
+            http = AuthorizedHttp(self._credentials(), http=_CountingHttp(self))
+            client_options = {'api_endpoint': DRIVE_API_ENDPOINT} if DRIVE_API_ENDPOINT else None
+            self._local.service = build('drive', 'v3', http=http, client_options=client_options)
+        return self._local.service
+
+    def new_batch(self, callback: Callable) -> BatchHttpRequest:
+        """
+        Create a batch request for the account Drive API endpoint
+        :param callback: Called for each response with (request_id, response, exception)
+        :return: empty batch request
+        """
+        if DRIVE_API_ENDPOINT:
+            return BatchHttpRequest(callback=callback, batch_uri=urljoin(DRIVE_API_ENDPOINT, '/batch/drive/v3'))
+        return self.service().new_batch_http_request(callback=callback)
+
+    def count_round_trip(self) -> None:
+        with self._throttle_lock:
+            self.round_trips += 1
+
+    def throttle(self) -> None:
+        """
+        Wait until the account could send another API request without exceeding its QPS limit
+        """
+        with self._throttle_lock:
+            now = monotonic()
+            wait_time = self._next_request_time - now
+            self._next_request_time = max(now, self._next_request_time) + self._interval
+        if wait_time > 0:
+            sleep(wait_time)
+
+
+class DriveManager:
+    """
+    Schedules uploads over all the Google Drive service accounts.
+    Each upload goes to the account with the fewest in-flight uploads that has enough free space,
+    preferring the account with the most free space, and fails over to another account if the
+    chosen account runs out of storage during the upload.
+    The files are placed in a folder for each show, and the public permissions are granted
+    by batch requests of up to BATCH_LIMIT files, call flush() after the last upload.
+    A file should be sent only after flush() reported it as shared.
+
+    Attributes:
+    - _credentials_dir (str): Directory of the credential JSON files.
+    - _accounts (list[DriveAccount] | None): The accounts, loaded on the first upload.
+    """
+    def __init__(self, credentials_dir: str = CREDENTIALS_DIR, qps: float = ACCOUNT_QPS):
+        """
+        Init the manager, the accounts free space is checked only on the first upload.
+        :param credentials_dir: Directory of the credential JSON files
+        :param qps: Maximum API requests per second for each account
+        """
+        self._credentials_dir = credentials_dir
+        self._qps = qps
+        self._accounts = None
+        self._uploaded_files = 0
+        self._shared_links = []
+        self._file_accounts = {}
+        self._lock = Lock()
+
+    @staticmethod
+    def _get_drive_free_space(account: DriveAccount) -> int:
+        """
+        Retrieves the free space available in Google Drive associated with the provided account.
+
+        Parameters:
+        - account (DriveAccount): The Google Drive account.
+
+        Returns:
+        int: Free space available in Google Drive (in bytes).
+        """
+        about = account.service().about().get(fields='storageQuota').execute()
+        free_space = int(about['storageQuota']['limit']) - int(about['storageQuota']['usage'])
+        return free_space
+
+    def _load_accounts(self) -> list[DriveAccount]:
+        if self._accounts is None:
+            cred_paths = sorted(os.path.join(self._credentials_dir, cred_name)
+                                for cred_name in os.listdir(self._credentials_dir) if cred_name.endswith('json'))
+            self._accounts = [DriveAccount(cred, qps=self._qps) for cred in cred_paths]
+            for account in self._accounts:
+                account.free_space = self._get_drive_free_space(account)
+        return self._accounts
+
+    def _reserve(self, file_size: int, exclude: list[DriveAccount]) -> Union[DriveAccount, None]:
+        """
+        Choose the account for a new upload and reserve the file size on it.
+        :param file_size: Size of the file to upload
+        :param exclude: Accounts that already failed for this file
+        :return: the chosen account, None if no account has enough free space
+        """
+        with self._lock:
+            candidates = [account for account in self._load_accounts()
+                          if not account.exhausted and account not in exclude and account.free_space > file_size]
+            if not candidates:
+                return None
+            account = min(candidates, key=lambda candidate: (candidate.in_flight, -candidate.free_space))
+            account.free_space -= file_size
+            account.in_flight += 1
+            return account
+
+    def _release(self, account: DriveAccount, file_size: int, uploaded: bool) -> None:
+        with self._lock:
+            account.in_flight -= 1
+            if not uploaded:
+                account.free_space += file_size
+
+    @staticmethod
+    def _execute(account: DriveAccount, request: Callable[[], Any]) -> Any:
+        """
+        Send an API request within the account QPS limit, retry rate limit, server errors and timeouts with backoff.
+        :param account: The account that sends the request
+        :param request: Callable that sends the request, like request.execute or request.next_chunk.
+         Retrying next_chunk resumes the same upload session
+        :return: the request response
+        :raise DriveAccountExhausted: if the account has no storage left
+        """
+        for attempt in range(MAX_RETRIES + 1):
+            account.throttle()
+            try:
+                return request()
+            except HttpError as e:
+                reason = _error_reason(e)
+                if reason in STORAGE_QUOTA_REASONS:
+                    raise DriveAccountExhausted(account.cred_path) from e
+                retryable = e.resp.status in RETRY_STATUS or (e.resp.status == 403 and reason in RATE_LIMIT_REASONS)
+                if not retryable or attempt == MAX_RETRIES:
+                    raise
+                backoff = min(2 ** attempt, MAX_BACKOFF) + random.random()
+                loger.warning(f'drive request failed with {e.resp.status} {reason}, retry in {backoff:.1f} seconds')
+                sleep(backoff)
+            except (TimeoutError, ConnectionError) as e:
+                # A failed upload chunk is resumed from the last byte the server received
+                if attempt == MAX_RETRIES:
+                    raise
+                backoff = min(2 ** attempt, MAX_BACKOFF) + random.random()
+                loger.warning(f'drive request failed with {e!r}, retry in {backoff:.1f} seconds')
+                sleep(backoff)
+
+    def _get_folder(self, account: DriveAccount, folder_name: str) -> str:
+        """
+        Get the ID of a folder by its name, create it if not exists. The IDs are cached for each account.
+        :param account: The account that owns the folder
+        :param folder_name: The folder name
+        :return: the folder ID
+        """
+        with account.lock:
+            if folder_name in account.folders:
+                return account.folders[folder_name]
+            drive_service = account.service()
+            escaped_name = folder_name.replace('\\', '\\\\').replace("'", "\\'")
+            query = f"mimeType='{FOLDER_MIME_TYPE}' and name='{escaped_name}' and trashed=false"
+            folders = self._execute(account, drive_service.files().list(q=query, fields='files(id)',
+                                                                          pageSize=1).execute)['files']
+            if folders:
+                folder_id = folders[0]['id']
+            else:
+                folder_metadata = {'name': folder_name, 'mimeType': FOLDER_MIME_TYPE}
+                folder_id = self._execute(account, drive_service.files().create(body=folder_metadata,
+                                                                                  fields='id').execute)['id']
+            account.folders[folder_name] = folder_id
+            return folder_id
+
+    def _flush_permissions(self, account: DriveAccount) -> None:
+        """
+        Make all the pending files of an account public, by batch requests of up to BATCH_LIMIT files.
+        Files that failed with rate limit or server errors are retried in the next batch with backoff.
+        A failed batch request leaves its files private and the next batches are still sent.
+        The links of the files that were made public are kept for flush() to return.
+        :param account: The account of the files
+        """
+        with account.lock:
+            pending, account.pending_permissions = account.pending_permissions, []
+        shared = []
+        private = []
+        for attempt in range(MAX_RETRIES + 1):
+            if not pending:
+                break
+            if attempt:
+                sleep(min(2 ** attempt, MAX_BACKOFF) + random.random())
+            failed = []
+
+            def _callback(file_id, response, exception):
+                if exception is None:
+                    shared.append(file_id)
+                    return
+                reason = _error_reason(exception)
+                if exception.resp.status in RETRY_STATUS or reason in RATE_LIMIT_REASONS:
+                    failed.append(file_id)
+                else:
+                    loger.error(f'failed to make file {file_id} public: {exception}')
+                    private.append(file_id)
+
+            drive_service = account.service()
+            for start in range(0, len(pending), BATCH_LIMIT):
+                batch_files = pending[start:start + BATCH_LIMIT]
+                batch = account.new_batch(_callback)
+                for file_id in batch_files:
+                    batch.add(drive_service.permissions().create(fileId=file_id, body=PUBLIC_PERMISSION,
+                                                                 fields='id'), request_id=file_id)
+                try:
+                    self._execute(account, batch.execute)
+                except Exception as e:
+                    loger.error(f'failed batch request of account {account.cred_path}: {e!r}')
+                    answered = set(shared + failed + private)
+                    private += [file_id for file_id in batch_files if file_id not in answered]
+            pending = failed
+        if private or pending:
+            loger.error(f'failed to make {len(private + pending)} files public: {private + pending}')
+        with self._lock:
+            self._shared_links += [_drive_link(file_id) for file_id in shared]
+
+    def flush(self) -> List[str]:
+        """
+        Send all the pending batched calls, must be called after the last upload.
+        The failures are logged and don't stop the flush of the other accounts.
+        :return: Links of the uploaded files that were made public, since the last flush
+        """
+        for account in self._accounts or []:
+            try:
+                self._flush_permissions(account)
+            except Exception as e:
+                loger.error(f'failed to flush the batched calls of account {account.cred_path}: {e!r}')
+        with self._lock:
+            shared_links, self._shared_links = self._shared_links, []
+        return shared_links
+
+    def delete(self, drive_links: List[str]) -> None:
+        """
+        Delete uploaded files, like files that could not be made public. A failed delete is only logged
+        :param drive_links: Google Drive links of files uploaded by this manager
+        """
+        for drive_link in drive_links:
+            file_id = drive_link.split('/')[-2]
+            account = self._file_accounts.get(file_id)
+            if account is None:
+                continue
+            try:
+                self._execute(account, account.service().files().delete(fileId=file_id).execute)
+            except Exception as e:
+                loger.error(f'failed to delete file {file_id}: {e!r}')
+                continue
+            with self._lock:
+                self._file_accounts.pop(file_id)
+
+    def report(self) -> dict:
+        """
+        Report the Drive API usage of this run, and write it into the log
+        :return: dict with the uploaded files, the API round-trips, and the round-trips per file
+        """
+        round_trips = sum(account.round_trips for account in self._accounts or [])
+        per_file = round_trips / self._uploaded_files if self._uploaded_files else 0
+        loger.info(f'drive api round-trips: {round_trips} for {self._uploaded_files} files '
+                   f'({per_file:.2f} per episode)')
+        return {'files': self._uploaded_files, 'round_trips': round_trips, 'round_trips_per_file': per_file}
+
+    def _upload_with_account(self, account: DriveAccount, file_path: str, file_name: str,
+                             mime_type: str, description: str, folder_name: str = None) -> str:
+        """
+        Upload a file with the given account, into the folder if given.
+        The file is made public later by a batch request, flush() reports when it's shared.
+        :return: Google Drive link to the uploaded file
+        """
+        drive_service = account.service()
+        file_metadata = {
+            'name': file_name,
+            'description': description
+        }
+        if folder_name:
+            file_metadata['parents'] = [self._get_folder(account, folder_name)]
+        media = MediaFileUpload(file_path, mimetype=mime_type, resumable=True,
+                                chunksize=_chunk_size(os.path.getsize(file_path)))
+        try:
+            request = drive_service.files().create(
+                body=file_metadata,
+                media_body=media,
+                fields='id'
+            )
+            response = None
+            while response is None:
+                status, response = self._execute(account, request.next_chunk)
+        finally:
+            media.stream().close()
+
+        with self._lock:
+            self._file_accounts[response['id']] = account
+        with account.lock:
+            account.pending_permissions.append(response['id'])
+            batch_full = len(account.pending_permissions) >= BATCH_LIMIT
+        if batch_full:
+            self._flush_permissions(account)
+        return _drive_link(response['id'])
+
+    def upload(self, file_path: str, file_name: str, mime_type: str, description: str,
+               folder_name: str = None) -> Union[str, None]:
+        """
+        Upload a file to the best available account, fail over to the other accounts if it runs out of storage.
+
+        Parameters:
+        - file_path (str): Path to the local file.
+        - file_name (str): The file name on Google Drive.
+        - mime_type (str): MIME type of the file.
+        - description (str): Description of the file.
+        - folder_name (str, optional): Folder to place the file in, created if not exists.
+
+        Returns:
+        str | None: Google Drive link to the uploaded file, None if no account has enough free space.
+        """
+        file_size = os.path.getsize(file_path)
+        failed_accounts = []
+        while True:
+            account = self._reserve(file_size, failed_accounts)
+            if account is None:
+                return None
+            uploaded = False
+            try:
+                drive_link = self._upload_with_account(account, file_path, file_name, mime_type, description,
+                                                       folder_name)
+                uploaded = True
+                with self._lock:
+                    self._uploaded_files += 1
+                return drive_link
+            except DriveAccountExhausted:
+                loger.warning(f'drive account {account.cred_path} is full, move the upload to another account')
+                account.exhausted = True
+                failed_accounts.append(account)
+            finally:
+                self._release(account, file_size, uploaded)
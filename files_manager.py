@@ -1,36 +1,84 @@
 import os.path
 import re
+import uuid
 import eyed3
-from typing import Union
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from threading import Event, Lock
+from typing import Union, Iterable, Tuple, List, NamedTuple
 from logging_manager import loger
 from time import time
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
-from google.oauth2.service_account import Credentials
-from googleapiclient.http import MediaFileUpload
 from db_manager import DatabaseManager
+from drive_manager import DriveManager
 from get_new_podcast import Podcast
+from lease_manager import WORKER_ID, LEASE_TTL
+from run_deadline import RunDeadline
+from id3_stripper import ID3Stripper
+import run_profiler
+import hashlib
 import requests
 
+# Number of podcast episodes downloaded and uploaded at the same time
+TRANSFER_WORKERS = int(os.environ.get('PODCAST_TRANSFER_WORKERS', 4))
+
+# Drop the big embedded pictures and the padding of the ID3 tag while downloading, the audio is kept untouched
+STRIP_ID3 = os.environ.get('PODCAST_STRIP_ID3', '0') == '1'
+
+# Timeouts in seconds of the episode download: to connect, and between bytes of the response
+DOWNLOAD_TIMEOUT = (float(os.environ.get('PODCAST_DOWNLOAD_CONNECT_TIMEOUT', 15)),
+                    float(os.environ.get('PODCAST_DOWNLOAD_READ_TIMEOUT', 60)))
+
+
+class _UploadedFile(NamedTuple):
+    """
+    Podcast episode uploaded to Google Drive, that is stored into the database once its file is shared.
+    """
+    podcast: Podcast
+    drive_link: str
+    size: int
+    duration: int
+    original_size: int
+
 
 class FilesManager:
     """
     Manages the download and upload of podcast files to Google Drive.
 
     Attributes:
-    - _podcast_list (list[Podcast]): List of Podcast objects to download and upload.
+    - _podcast_list (Iterable[Podcast]): Podcast objects to download and upload, could be a generator.
     - _db (DatabaseManager): Database manager to interact with the database.
+    - _drive (DriveManager): Schedules the uploads over the Google Drive accounts.
+    - _show_titles (dict[int, str]): Cache of podcast show ID to its title.
+    - _transfer_workers (int): Number of episodes transferred at the same time.
+    - _deadline (RunDeadline): The run deadline, after it no new episode is started.
+    - _strip_id3 (bool): Strip the big pictures and padding of the ID3 tag while downloading.
+    - _uploaded (list[_UploadedFile]): Uploaded episodes that wait for their files to be shared.
+    - _held_leases (list[str]): Leases of the uploaded episodes, released once the episodes are stored.
+    - _stored_files (list[int]): IDs of the podcast files stored by this run.
     """
-    def __init__(self, podcast_list: list[Podcast], db: DatabaseManager):
+    def __init__(self, podcast_list: Iterable[Podcast], db: DatabaseManager,
+                 transfer_workers: int = TRANSFER_WORKERS, deadline: RunDeadline = None, strip_id3: bool = STRIP_ID3):
         """
         Initializes the FilesManager with the provided list of podcasts and a database manager.
 
         Parameters:
-        - podcast_list (list[Podcast]): List of Podcast objects.
+        - podcast_list (Iterable[Podcast]): Podcast objects, consumed one by one while downloading.
         - db (DatabaseManager): Instance of database manager.
+        - transfer_workers (int): Number of episodes transferred at the same time.
+        - deadline (RunDeadline, optional): The run deadline, None for no limit.
+        - strip_id3 (bool): Strip the big pictures and padding of the ID3 tag while downloading.
         """
         self._podcast_list = podcast_list
         self._db = db
+        self._drive = DriveManager()
+        self._show_titles = {}
+        self._transfer_workers = transfer_workers
+        self._drive_full = Event()
+        self._deadline = deadline
+        self._strip_id3 = strip_id3
+        self._uploaded = []
+        self._held_leases = []
+        self._stored_files = []
+        self._lock = Lock()
 
     @staticmethod
     def _make_valid_file_name(file_name: str, ext: str) -> str:
@@ -52,116 +100,75 @@ class FilesManager:
             clean_string = 'untitled'
         return clean_string + ext
 
-    @staticmethod
-    def _get_drive_free_space(cred_path: str) -> int:
-        """
-        Retrieves the free space available in Google Drive associated with the provided credentials.
-
-        Parameters:
-        - cred_path (str): Path to the JSON file containing Google Drive credentials.
-
-        Returns:
-        int: Free space available in Google Drive (in bytes).
-        """
-        drive_service = build('drive', 'v3', credentials=Credentials.from_service_account_file(cred_path))
-        about = drive_service.about().get(fields='storageQuota').execute()
-        free_space = int(about['storageQuota']['limit']) - int(about['storageQuota']['usage'])
-        return free_space
-
-    def _get_credential(self, file_size: int) -> Union[str, None]:
-        """
-        Selects a valid Google Drive credential file based on available free space.
-
-        Parameters:
-        - file_size (int): Size of the file to be uploaded.
-
-        Returns:
-        str | None: The path to the selected credential file is provided if it exists. If no credential file is found
-         or there isn't enough storage space for the given size, 'None' is returned
-        """
-        cred_paths = [os.path.join('credentials', cred_name) for cred_name in os.listdir('credentials')
-                      if cred_name.endswith('json')]
-        for cred in cred_paths:
-            if self._get_drive_free_space(cred) > file_size:
-                return cred
-        return None
-
-    def _download_podcast(self, file_url: str, file_name: str) -> Union[str, None]:
+    def _download_podcast(self, file_url: str, file_name: str) -> Union[Tuple[str, int], None]:
         """
         Downloads a podcast file from the provided URL.
+        If strip_id3 is set, the ID3 tag is stripped in the same pass, while the file is written.
 
         Parameters:
         - file_url (str): URL of the podcast file.
         - file_name (str): Name of the podcast file.
 
         Returns:
-        str or None: Path to the downloaded file or None if unsuccessful.
+        tuple[str, int] or None: Path to the downloaded file and the original file size, None if unsuccessful.
         """
+        # A unique prefix, so concurrent downloads of episodes with the same name don't collide
         valid_file_name = self._make_valid_file_name(file_name, '.mp3')
-        file_path = f'files/{valid_file_name}'
+        file_path = f'files/{uuid.uuid4().hex[:8]}-{valid_file_name}'
         try:
-            response = requests.get(file_url, stream=True)
-            content_type = response.headers.get('Content-Type', '')
-            if 'audio/mpeg' not in content_type.lower():
-                loger.warning(f'link: {file_url} not contain audio podcast. the content is: {content_type}')
-                return None
-        except requests.exceptions.ConnectionError as e:
-            loger.error(e)
-            return None
-        except requests.exceptions.MissingSchema as e:
-            loger.error(e)
-            return None
-        if response.status_code != 200:
+            with requests.get(file_url, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+                content_type = response.headers.get('Content-Type', '')
+                if 'audio/mpeg' not in content_type.lower():
+                    loger.warning(f'link: {file_url} not contain audio podcast. the content is: {content_type}')
+                    return None
+                if response.status_code != 200:
+                    return None
+                chunk_size = 1024 * 1024  # TODO: Check the optimal chunk size for download
+                original_size = 0
+                with open(file_path, 'wb') as f:
+                    stream = ID3Stripper(f) if self._strip_id3 else f
+                    for chunk in response.iter_content(chunk_size=chunk_size):
+                        stream.write(chunk)
+                        original_size += len(chunk)
+                    if self._strip_id3:
+                        stream.close()
+        except requests.exceptions.RequestException as e:
+            # Connection errors and timeouts, include a host that stopped sending in the middle of the file
+            loger.error(f'failed to download: {file_url} {e}')
+            if os.path.exists(file_path):
+                os.remove(file_path)
             return None
-        chunk_size = 1024 * 1024  # TODO: Check the optimal chunk size for download
-        with open(file_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=chunk_size):
-                f.write(chunk)
-        return file_path
+        return file_path, original_size
 
-    @staticmethod
-    def _upload_podcast(file_path: str, mime_type: str, description: str, credential_json: str) -> str:
+    def _get_show_title(self, podcast_id: int) -> str:
+        """
+        Get the podcast show title, used as the Google Drive folder of its episodes
+        :param podcast_id: The ID of the podcast show
+        :return: the show title
         """
-        Uploads a podcast file to Google Drive.
+        if podcast_id not in self._show_titles:
+            self._show_titles[podcast_id] = self._db.fetch_rss(podcast_id).title or f'podcast {podcast_id}'
+        return self._show_titles[podcast_id]
+
+    def _upload_podcast(self, file_path: str, file_name: str, mime_type: str, description: str,
+                        folder_name: str) -> Union[str, None]:
+        """
+        Uploads a podcast file to Google Drive and delete the local file.
 
         Parameters:
         - file_path (str): Path to the local podcast file.
+        - file_name (str): The file name on Google Drive.
         - mime_type (str): MIME type of the file.
         - description (str): Description of the podcast episode.
-        - credential_json (str): Path to the JSON file containing Google Drive credentials.
+        - folder_name (str): The Google Drive folder of the file.
 
         Returns:
-        str: Google Drive link to the uploaded file.
-        """
-        credentials = service_account.Credentials.from_service_account_file(
-            credential_json,
-            scopes=['https://www.googleapis.com/auth/drive']
-        )
-        drive_service = build('drive', 'v3', credentials=credentials)
-        file_metadata = {
-            'name': os.path.basename(file_path),
-            'description': description
-        }
-        media = MediaFileUpload(file_path, mimetype=mime_type, resumable=True)
-        request = drive_service.files().create(
-            body=file_metadata,
-            media_body=media,
-            fields='id'
-        )
-        response = None
-        while response is None:
-            status, response = request.next_chunk()
-        permission = {
-            'type': 'anyone',
-            'role': 'reader',
-        }
-        media.stream().close()
-        drive_service.permissions().create(
-            fileId=response['id'],
-            body=permission
-        ).execute()
-        os.remove(file_path)
-        return f"https://drive.google.com/file/d/{response['id']}/view"
+        str | None: Google Drive link to the uploaded file, None if no account has enough free space.
+        """
+        try:
+            return self._drive.upload(file_path, file_name, mime_type, description, folder_name)
+        finally:
+            os.remove(file_path)
 
     # TODO: it seams that this method not necessary and could be replace by insert_podcast_file
     def _store_podcast_date(self, podcast_id, drive_link, source_link,
@@ -183,33 +190,149 @@ class FilesManager:
         else:
             return 0
 
+    def _transfer_podcast(self, podcast: Podcast) -> bool:
+        """
+        Download and upload one podcast episode, it's stored into the database once its file is shared
+        :param podcast: The podcast episode to transfer
+        :return: False if there is no space left on google drive, otherwise True
+        """
+        start_podcast_time = time()
+        file_url = podcast.source_link
+        file_name = podcast.name
+        download = self._download_podcast(file_url, file_name)
+        if not download:
+            loger.error(f'got None for podcast: {file_name}')
+            return True
+        file_path, original_size = download
+        duration = self._get_duration(file_path)
+        description = podcast.description
+        file_size = os.path.getsize(file_path)
+        drive_link = self._upload_podcast(file_path, self._make_valid_file_name(file_name, '.mp3'),
+                                          'audio/mpeg', description, self._get_show_title(podcast.podcast_id))
+        if not drive_link:
+            loger.error("You don't have enough space on google drive. "
+                        "provide another credential as soon as possible")
+            return False
+        # The episode is stored only after its file is shared, so a private link is never sent
+        with self._lock:
+            self._uploaded.append(_UploadedFile(podcast, drive_link, file_size, duration, original_size))
+        loger.info(f'download and upload file: {file_name} size: {(file_size / 1024 ** 2):.1f} MB '
+                   f'(original {(original_size / 1024 ** 2):.1f} MB) '
+                   f'in: {(time() - start_podcast_time):.1f} seconds')
+        return True
+
+    def _transfer_leased_podcast(self, podcast: Podcast, lease: str) -> None:
+        """
+        Transfer one podcast episode that its lease already taken, and release the lease.
+        The lease of an uploaded episode is held until the episode is stored.
+        :param podcast: The podcast episode to transfer
+        :param lease: The episode lease name
+        :return: None
+        """
+        try:
+            if self._db.podcast_file_exists(podcast.source_link):
+                loger.info(f'podcast: {podcast.name} already uploaded')
+                return
+            if not self._transfer_podcast(podcast):
+                self._drive_full.set()
+        finally:
+            with self._lock:
+                uploaded = any(uploaded_file.podcast is podcast for uploaded_file in self._uploaded)
+                if uploaded:
+                    self._held_leases.append(lease)
+            if not uploaded:
+                self._db.release_lease(lease, WORKER_ID)
+
+    def _store_shared_files(self, shared_links: List[str]) -> None:
+        """
+        Store the uploaded episodes whose files are shared, and render their episode boxes for the digest.
+        The files that stayed private are deleted, and their feeds are read again by the next run to retry them.
+        :param shared_links: Links of the shared files, as reported by the drive flush
+        :return: None
+        """
+        from create_email_message import cache_podcast_fragment
+        shared_links = set(shared_links)
+        private_files = []
+        for uploaded_file in self._uploaded:
+            if uploaded_file.drive_link not in shared_links:
+                private_files.append(uploaded_file)
+                continue
+            podcast = uploaded_file.podcast
+            podcast_file = self._db.insert_podcast_file(podcast.podcast_id, uploaded_file.drive_link,
+                                                        podcast.source_link, podcast.name, podcast.description,
+                                                        uploaded_file.size, uploaded_file.duration,
+                                                        podcast.published_date,
+                                                        uploaded_file.original_size if self._strip_id3 else None)
+            self._stored_files.append(podcast_file.id)
+            # Render the episode box once, while the record is at hand, the digest renders it again if missing
+            try:
+                cache_podcast_fragment(podcast_file)
+            except Exception as e:
+                loger.warning(f'failed to cache the email fragment of file: {podcast.name}: {e}')
+        self._uploaded = []
+
+        if private_files:
+            loger.error(f'{len(private_files)} uploaded podcast files are private, retried by the next run: '
+                        f'{[uploaded_file.podcast.source_link for uploaded_file in private_files]}')
+            self._drive.delete([uploaded_file.drive_link for uploaded_file in private_files])
+            for podcast_id in {uploaded_file.podcast.podcast_id for uploaded_file in private_files}:
+                self._db.rewind_rss(podcast_id)
+
+    def report_saved_bytes(self) -> None:
+        """
+        Log the bytes saved by stripping the ID3 tags in this run, for each feed
+        :return: None
+        """
+        for title, original_size, size, files_count in self._db.fetch_saved_bytes(self._stored_files):
+            loger.info(f'{title}: saved {((original_size - size) / 1024 ** 2):.1f} MB of '
+                       f'{(original_size / 1024 ** 2):.1f} MB in {files_count} files')
+
     def get_all_podcast(self):
         """
-        Download, upload, and store the data into the database for all podcast episodes in podcast_list
+        Download, upload, and store the data into the database for all podcast episodes in podcast_list.
+        Up to transfer_workers episodes are transferred at the same time, and the uploads are spread
+        over the Google Drive accounts.
+        Each episode is transferred only after taking its lease, so several workers won't upload the same episode.
+        After the run deadline no new episode is started, the running transfers are finished.
         :return: None
         """
         start_all_time = time()
-        for podcast in self._podcast_list:
-            start_podcast_time = time()
-            file_url = podcast.source_link
-            file_name = podcast.name
-            file_path = self._download_podcast(file_url, file_name)
-            if not file_path:
-                loger.error(f'got None for podcast: {file_name}')
-                continue
-            duration = self._get_duration(file_path)
-            description = podcast.description
-            file_size = os.path.getsize(file_path)
-            cred_path = self._get_credential(file_size)
-            if not cred_path:
-                loger.error("You don't have enough space on google drive. "
-                            "provide another credential as soon as possible")
-                os.remove(file_path)
-                break
-            drive_link = self._upload_podcast(file_path, 'audio/mpeg', description, cred_path)
-            self._db.insert_podcast_file(podcast.podcast_id, drive_link, file_url, file_name, description,
-                                         file_size, duration, podcast.published_date)
-            loger.info(f'download and upload file: {file_name} size: {(file_size / 1024 ** 2):.1f} MB '
-                       f'in: {(time() - start_podcast_time):.1f} seconds')
-
-        loger.info(f'download and upload {len(self._podcast_list)} podcast in {(time() - start_all_time):.1f} seconds')
+        podcast_count = 0
+        running = set()
+        try:
+            with ThreadPoolExecutor(max_workers=self._transfer_workers, thread_name_prefix='transfer') as executor:
+                for podcast in self._podcast_list:
+                    if self._drive_full.is_set():
+                        break
+                    if self._deadline is not None and self._deadline.expired():
+                        loger.warning('run deadline reached, the rest of the episodes are left to the next run')
+                        break
+                    podcast_count += 1
+                    lease = f'episode:{hashlib.md5(str(podcast.source_link).encode()).hexdigest()}'
+                    if not self._db.acquire_lease(lease, WORKER_ID, LEASE_TTL):
+                        loger.info(f'podcast: {podcast.name} is handled by another worker')
+                        continue
+
+                    # Wait for a free worker, so the episodes are pulled from podcast_list only when they can start
+                    if len(running) >= self._transfer_workers:
+                        done, running = wait(running, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            future.result()
+                    running.add(executor.submit(run_profiler.profiled('transfer', self._transfer_leased_podcast),
+                                                podcast, lease))
+
+                for future in running:
+                    future.result()
+        finally:
+            # Make the uploaded files public by the remaining batched calls, also if a transfer failed,
+            # and store only the episodes whose files are shared
+            try:
+                self._store_shared_files(self._drive.flush())
+            finally:
+                for lease in self._held_leases:
+                    self._db.release_lease(lease, WORKER_ID)
+                self._held_leases = []
+            self._drive.report()
+        if self._strip_id3:
+            self.report_saved_bytes()
+        loger.info(f'download and upload {podcast_count} podcast in {(time() - start_all_time):.1f} seconds')
@@ -1,14 +1,52 @@
+import os
 import feedparser
 from feedparser.util import FeedParserDict
-import dicttoxml
 from db_manager import DatabaseManager
-from bs4 import BeautifulSoup
 import time
-from datetime import datetime, date
+import gzip
+import zlib
+import urllib.error
+import urllib.request
+from urllib.parse import urljoin
+from email.utils import parsedate_to_datetime
+from datetime import datetime, date, timedelta, timezone
 from logging_manager import loger
-from typing import Union
+from lease_manager import WORKER_ID, LEASE_TTL
+from run_deadline import RunDeadline
+from typing import Union, Iterator, NamedTuple
+from dataclasses import dataclass
+from queue import Queue, Full
+from threading import Thread, Event
 
+# The streaming parser sanitizes the descriptions the same way feedparser does, by its private _sanitize_html.
+# feedparser is pinned to an exact version in requirements.txt for it, and without it the feeds are left to feedparser
+try:
+    from feedparser.sanitizer import _sanitize_html
+except ImportError:
+    _sanitize_html = None
 
+# Timeout in seconds for the whole RSS request, include reading the response
+FEED_TIMEOUT = float(os.environ.get('PODCAST_FEED_TIMEOUT', 30))
+
+# Consecutive failures after them a feed is skipped until its next probe
+FEED_FAILURE_THRESHOLD = 3
+
+# Seconds until the first probe of an unhealthy feed, doubled after each failed probe
+FEED_PROBE_INTERVAL = 6 * 3600
+
+# Maximum seconds between probes of an unhealthy feed
+FEED_MAX_PROBE_INTERVAL = 7 * 24 * 3600
+
+# Size of each read from the RSS response
+FEED_READ_SIZE = 64 * 1024
+
+# Maximum number of discovered episodes waiting for transfer
+MAX_PENDING_PODCAST = 8
+
+ITUNES_NS = '{http://www.itunes.com/dtds/podcast-1.0.dtd}'
+
+
+@dataclass(frozen=True, slots=True)
 class Podcast:
     """
     Represents a podcast entry with basic information.
@@ -20,25 +58,41 @@ class Podcast:
     - description (str): Description of the podcast.
     - published_date (datetime): Date and time when the podcast was published.
     """
-    def __init__(self, podcast_id: int, name: str, source_link: str, description: str, published_date: datetime):
-        """
-        Init the podcast instance with given details
-        :param podcast_id: (int): ID of the podcast class.
-        :param name: (str): Name of the podcast episode.
-        :param source_link: (str): Source link to the podcast.
-        :param description: (str): Description of the podcast.
-        :param published_date: (datetime): Date and time when the podcast was published.
-        """
-        self.podcast_id = podcast_id
-        self.name = name
-        self.source_link = source_link
-        self.description = description
-        self.published_date = published_date
+    podcast_id: int
+    name: str
+    source_link: str
+    description: str
+    published_date: datetime
+
+
+class FeedError(Exception):
+    """
+    The RSS feed could not be fetched or parsed.
+    """
+
+
+class _TimedReader:
+    """
+    Binary stream that fails when the whole response is read for longer than the timeout.
+    The socket timeout only limits each read, so a host that sends the response slowly is stopped here.
+    Each read returns the bytes already available, so the time is checked while the response trickles.
+    """
+    def __init__(self, stream, timeout: float):
+        self._stream = stream
+        self._timeout = timeout
+        self._expires_at = time.monotonic() + timeout
+
+    def read(self, size: int = -1) -> bytes:
+        if time.monotonic() > self._expires_at:
+            raise TimeoutError(f'reading the response took more than {self._timeout} seconds')
+        return self._stream.read1(size)
 
 
 def _get_mp3_link(entry: FeedParserDict) -> Union[str, None]:
     """
-    Extracts the MP3 link from a podcast entry using dictoxml and BeautifulSoup.
+    Extracts the MP3 link from a podcast entry.
+    The enclosures and links of the entry are checked first, and only if no MP3 link found there
+    the whole entry is scanned using dictoxml and BeautifulSoup.
 
     Parameters:
     - entry (FeedParserDict): Podcast entry dictionary.
@@ -46,6 +100,15 @@ def _get_mp3_link(entry: FeedParserDict) -> Union[str, None]:
     Returns:
     str or None: MP3 link if found, otherwise None.
     """
+    for link in entry.get('enclosures', []) + entry.get('links', []):
+        href = link.get('href') or ''
+        if '.mp3' in href:
+            return href
+
+    # Imported here to keep them out of the discovery startup path
+    import dicttoxml
+    from bs4 import BeautifulSoup
+
     try:
         xml_entry = dicttoxml.dicttoxml(dict(entry))
     except TypeError as e:
@@ -55,66 +118,359 @@ def _get_mp3_link(entry: FeedParserDict) -> Union[str, None]:
     return next(iter([link.text for link in soup.find_all('href') if '.mp3' in link.text]), None)
 
 
+class _FeedEntry(NamedTuple):
+    """
+    The fields of a single RSS entry that are needed to create a Podcast.
+    """
+    entry_id: Union[str, None]
+    name: Union[str, None]
+    published: datetime
+    source_link: Union[str, None]
+    description: Union[str, None]
+
+
+def _parse_rss_date(date_text: str) -> datetime:
+    """
+    Parse an RFC 822 RSS date into a naive datetime the same way feedparser published_parsed is converted.
+    :param date_text: The pubDate text of the entry
+    :return: naive datetime of the published date
+    :raise ValueError, TypeError: if the date is not a valid RFC 822 date
+    """
+    published = parsedate_to_datetime(date_text.strip())
+    if published.tzinfo is not None:
+        published = published.astimezone(timezone.utc)
+    return datetime.fromtimestamp(time.mktime(published.timetuple()))
+
+
+def _item_to_entry(item, base_url: str) -> Union[_FeedEntry, None]:
+    """
+    Extract the needed fields from an RSS <item> element.
+    :param item: lxml element of the RSS item
+    :param base_url: The URL of the feed, to resolve permalink IDs as feedparser does
+    :return: _FeedEntry with the item details, None if the item can't be parsed without feedparser
+    """
+    try:
+        published = _parse_rss_date(item.findtext('pubDate'))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+    entry_id = None
+    guid = item.find('guid')
+    if guid is not None and guid.text:
+        entry_id = guid.text.strip()
+        if guid.get('isPermaLink', 'true').lower() != 'false':
+            entry_id = urljoin(base_url, entry_id)
+    name = item.findtext('title')
+    description = item.findtext('description') or item.findtext(f'{ITUNES_NS}summary')
+
+    source_link = None
+    for enclosure in item.iterfind('enclosure'):
+        if '.mp3' in enclosure.get('url', ''):
+            source_link = enclosure.get('url').strip()
+            break
+    link = item.findtext('link')
+    if not source_link and link and '.mp3' in link:
+        source_link = link.strip()
+
+    return _FeedEntry(entry_id,
+                      name.strip() if name else name,
+                      published,
+                      source_link,
+                      _sanitize_html(description, 'utf-8', 'text/html') if description else description)
+
+
+def _open_feed(rss_url: str, etag: str):
+    """
+    Open the RSS feed request with the feed timeout.
+    :param rss_url: The URL of the RSS feed
+    :param etag: The ETag string for quick checking of new episodes
+    :return: The response, None if the feed is not modified
+    :raise FeedError: if the server returned an error status
+    :raise OSError: if the request failed or timed out
+    :raise ValueError: if the URL is not an http URL
+    """
+    headers = {'User-Agent': feedparser.USER_AGENT, 'Accept-Encoding': 'gzip'}
+    if etag:
+        headers['If-None-Match'] = etag
+    try:
+        return urllib.request.urlopen(urllib.request.Request(rss_url, headers=headers), timeout=FEED_TIMEOUT)
+    except urllib.error.HTTPError as e:
+        e.close()
+        if e.code == 304:
+            return None
+        raise FeedError(f'got status {e.code}') from e
+
+
+def _response_stream(response):
+    """
+    :param response: The RSS feed response
+    :return: stream of the decoded response body, limited by the feed timeout
+    """
+    stream = _TimedReader(response, FEED_TIMEOUT)
+    if response.headers.get('Content-Encoding', '').lower() == 'gzip':
+        return gzip.GzipFile(fileobj=stream)
+    return stream
+
+
+def _stream_feed(rss_url: str, etag: str, old_newz_id: str,
+                 last_date: date) -> Union[tuple[str, list[_FeedEntry]], None]:
+    """
+    Fetch an RSS 2.0 feed with an incremental parser that stops reading as soon as
+    the last known entry or the last date is reached, and closes the connection.
+    :param rss_url: The URL of the RSS feed
+    :param etag: The ETag string for quick checking of new episodes
+    :param old_newz_id: The ID string of the last known episode
+    :param last_date: The last date to consider for retrieving updates
+    :return: tuple of the new ETag and the entries until (and include) the first already known entry.
+     None if the feed should be parsed by feedparser instead
+    :raise FeedError, OSError: if the feed could not be fetched
+    """
+    try:
+        from lxml import etree
+    except ImportError:
+        return None
+    if _sanitize_html is None:
+        return None
+
+    try:
+        response = _open_feed(rss_url, etag)
+    except ValueError:
+        # Not an http url, let feedparser handle it
+        return None
+    if response is None:
+        return etag, []
+
+    entries = []
+    with response:
+        new_etag = response.headers.get('ETag') or ''
+        context = etree.iterparse(_response_stream(response), events=('end',), tag='item',
+                                  resolve_entities=False, no_network=True)
+        try:
+            for _, item in context:
+                entry = _item_to_entry(item, response.geturl())
+
+                # Free the parsed items to keep the memory bounded
+                item.clear()
+                while item.getprevious() is not None:
+                    del item.getparent()[0]
+
+                if entry is None:
+                    return None
+                entries.append(entry)
+                if entry.published.date() < last_date or entry.entry_id == old_newz_id:
+                    break
+        except (etree.XMLSyntaxError, EOFError, zlib.error, gzip.BadGzipFile) as e:
+            loger.warning(f'malformed rss: {rss_url} {e}. fallback to feedparser')
+            return None
+
+    # Other feed formats (Atom, RSS 1.0) are left to feedparser
+    if not entries and (context.root is None or context.root.tag != 'rss'):
+        return None
+
+    return new_etag, entries
+
+
+def _parse_feed(rss_url: str, etag: str) -> tuple[str, Iterator[_FeedEntry]]:
+    """
+    Fetch and parse the whole feed with feedparser.
+    :param rss_url: The URL of the RSS feed
+    :param etag: The ETag string for quick checking of new episodes
+    :return: tuple of the new ETag and a lazy iterator of the feed entries
+    :raise FeedError, OSError: if the feed could not be fetched or parsed
+    """
+    try:
+        response = _open_feed(rss_url, etag)
+    except ValueError:
+        # Not an http url, like a local file
+        feed = feedparser.parse(rss_url, etag=etag)
+        new_etag = feed.get('etag') if feed.get('etag') else ''
+    else:
+        if response is None:
+            return etag, iter([])
+
+        # The feed is read here with the feed timeout, feedparser only parses it
+        with response:
+            stream = _response_stream(response)
+            try:
+                data = b''.join(iter(lambda: stream.read(FEED_READ_SIZE), b''))
+            except (EOFError, zlib.error, gzip.BadGzipFile) as e:
+                raise FeedError(f'malformed response: {e}') from e
+            new_etag = response.headers.get('ETag') or ''
+            feed = feedparser.parse(data, response_headers={'content-location': response.geturl(),
+                                                            'content-type': response.headers.get('Content-Type', '')})
+    if feed.bozo and not feed.entries:
+        raise FeedError(f'malformed rss: {feed.get("bozo_exception")}')
+    return new_etag, _feedparser_entries(feed.entries)
+
+
+def _feedparser_entries(feed_entries: list[FeedParserDict]) -> Iterator[_FeedEntry]:
+    """
+    Lazy conversion of the feedparser entries, so only the entries until the last known one are converted.
+    A malformed entry, like an entry without a published date, is logged and skipped.
+    :param feed_entries: The entries parsed by feedparser
+    :return: generator of the feed entries
+    """
+    for entry in feed_entries:
+        try:
+            yield _FeedEntry(entry.get('id'),
+                             entry.get('title'),
+                             datetime.fromtimestamp(time.mktime(entry.get('published_parsed'))),
+                             _get_mp3_link(entry),
+                             entry.get('summary'))
+        except Exception as e:
+            loger.warning(f'skipped malformed entry {entry.get("id")}: {e!r}')
+
+
+def _next_probe(failures: int) -> Union[datetime, None]:
+    """
+    Circuit breaker of the feeds: after FEED_FAILURE_THRESHOLD consecutive failures the feed is skipped,
+    and probed again after an interval that doubles with each failed probe.
+    :param failures: The number of consecutive failures of the feed
+    :return: UTC date and time of the next probe, None if the feed should be checked on every run
+    """
+    if failures < FEED_FAILURE_THRESHOLD:
+        return None
+    interval = min(FEED_PROBE_INTERVAL * 2 ** (failures - FEED_FAILURE_THRESHOLD), FEED_MAX_PROBE_INTERVAL)
+    return datetime.utcnow() + timedelta(seconds=interval)
+
+
 def _get_new_podcast(db: DatabaseManager, podcast_id: int, rss_url: str,
-                     etag: str, old_newz_id: str, last_date: date) -> list[Podcast]:
+                     etag: str, old_newz_id: str, last_date: date, failures: int = 0) -> Iterator[Podcast]:
     """
     Fetches details of new podcast episodes from the specified RSS feed until the given date.
+    The RSS details are updated in the database only after all the new episodes were consumed.
+    The fetch result is recorded in the feed health.
     :param db: Database manager instance to update the RSS details with the new ETag, last entry ID, and date.
     :param podcast_id: The unique identifier of the podcast class.
     :param rss_url: The URL of the RSS feed to retrieve podcast episode details from.
     :param etag: The ETag string for quick checking of new episodes.
     :param old_newz_id: The ID string of the last known episode.
     :param last_date: The last date to consider for retrieving updates.
-    :return: A list of Podcast objects containing details of all new podcast episodes.
+    :param failures: The number of consecutive failures of the feed before this fetch.
+    :return: A generator of Podcast objects containing details of all new podcast episodes.
     """
 
-    new_podcast = []
-
-    # get the RSS feed data
+    # get the RSS feed data, by the streaming parser if possible
     start_check_time = time.time()
-    feed = feedparser.parse(rss_url, etag=etag)
-    loger.debug(f'time to fetch rss {podcast_id}: {(time.time()-start_check_time):.1f} seconds')
+    try:
+        feed_data = _stream_feed(rss_url, etag, old_newz_id, last_date)
+        if feed_data is None:
+            feed_data = _parse_feed(rss_url, etag)
+    except (FeedError, OSError) as e:
+        next_probe = _next_probe(failures + 1)
+        failures = db.record_feed_failure(podcast_id, str(e), next_probe)
+        loger.error(f'failed to fetch rss {podcast_id}: {rss_url} {e}. {failures} consecutive failures' +
+                    (f', skipped until {next_probe:%Y-%m-%d %H:%M} UTC' if next_probe else ''))
+        return
+    new_etag, entries = feed_data
+    fetch_time = time.time() - start_check_time
+    loger.debug(f'time to fetch rss {podcast_id}: {fetch_time:.1f} seconds')
 
-    entries = feed.entries
-    if not entries:
-        loger.debug('no newz receive. exit...')
-        return new_podcast
+    new_podcast_count = 0
     last_newz_id = ''
     last_newz_date = ''
-    new_etag = feed.get('etag') if feed.get('etag') else ''
 
-    # analyze the new episodes
+    # analyze the new episodes, the feed health is recorded after the entries were parsed
     start_check_time = time.time()
     for entry in entries:
-        published = datetime.fromtimestamp(time.mktime(entry.get('published_parsed')))
-        entry_id = entry.get('id')
-        last_newz_id = entry_id if not last_newz_id else last_newz_id
-        last_newz_date = published if not last_newz_date else last_newz_date
+        last_newz_id = entry.entry_id if not last_newz_id else last_newz_id
+        last_newz_date = entry.published if not last_newz_date else last_newz_date
 
-        if published.date() < last_date or entry_id == old_newz_id:
+        if entry.published.date() < last_date or entry.entry_id == old_newz_id:
             break
 
-        name = entry.get('title')
-        source_link = _get_mp3_link(entry)
-        description = entry.get('summary')
-        new_entry = Podcast(podcast_id, name, source_link, description, published)
-        new_podcast.append(new_entry)
+        new_podcast_count += 1
+        yield Podcast(podcast_id, entry.name, entry.source_link, entry.description, entry.published)
+    db.record_feed_success(podcast_id, fetch_time)
 
-    db.update_rss(podcast_id, new_etag, last_newz_id, last_newz_date)
-    loger.info(f'got {len(new_podcast)} new podcast. time to analyze: {(time.time() - start_check_time):.3f} seconds')
+    if not last_newz_date:
+        loger.debug('no newz receive. exit...')
+        return
 
-    return new_podcast
+    db.update_rss(podcast_id, new_etag, last_newz_id, last_newz_date)
+    loger.info(f'got {new_podcast_count} new podcast. '
+               f'time to analyze: {(time.time() - start_check_time):.3f} seconds')
 
 
-def get_all_new_podcast(db: DatabaseManager, last_date: date) -> list[Podcast]:
+def get_all_new_podcast(db: DatabaseManager, last_date: date, worker_id: str = WORKER_ID,
+                        deadline: RunDeadline = None) -> Iterator[Podcast]:
     """
-    Get the all new podcast episodes until the given date
+    Get the all new podcast episodes until the given date, feed after feed.
+    Each feed is checked only after taking its lease, so several workers can share the feeds without overlap.
+    The lease is held until all the feed episodes are consumed.
+    Unhealthy feeds are skipped until their next probe, and no feed is checked after the run deadline.
     :param db: Database manager instance to fetch and update the RSS data
     :param last_date: date object with only a date
-    :return: list with Podcast instance represent the all new podcast episodes
+    :param worker_id: ID of the worker to take the feed leases
+    :param deadline: The run deadline, None for no limit
+    :return: generator of Podcast instance represent the all new podcast episodes
+    """
+    for rss_id in [rss.id for rss in db.fetch_all_rss()]:
+        if deadline is not None and deadline.expired():
+            loger.warning('run deadline reached, the rest of the feeds are left to the next run')
+            return
+        lease = f'rss:{rss_id}'
+        if not db.acquire_lease(lease, worker_id, LEASE_TTL):
+            loger.debug(f'rss {rss_id} is handled by another worker')
+            continue
+        try:
+            health = db.fetch_feed_health(rss_id)
+            if health is not None and health.next_probe is not None and health.next_probe > datetime.utcnow():
+                loger.info(f'rss {rss_id} failed {health.consecutive_failures} times, '
+                           f'skipped until {health.next_probe:%Y-%m-%d %H:%M} UTC')
+                continue
+
+            # Read the RSS data again after taking the lease, another worker could update it meanwhile
+            rss = db.fetch_rss(rss_id)
+            yield from _get_new_podcast(db, rss.id, rss.rss_link, rss.e_tag, rss.last_newz_id, last_date,
+                                        health.consecutive_failures if health is not None else 0)
+        finally:
+            db.release_lease(lease, worker_id)
+
+
+def prefetch_new_podcast(new_podcast: Iterator[Podcast], max_pending: int = MAX_PENDING_PODCAST) -> Iterator[Podcast]:
     """
-    all_new_podcast = []
-    all_rss_url = [(rss.rss_link, rss.id, rss.e_tag, rss.last_newz_id) for rss in db.fetch_all_rss()]
-    for rss_url, rss_id, etag, last_newz_id in all_rss_url:
-        all_new_podcast += _get_new_podcast(db, rss_id, rss_url, etag, last_newz_id, last_date)
-    return all_new_podcast
+    Consume the new podcast generator in a background thread, so the transfer of the first episodes
+    can start while the later feeds are still fetched.
+    At most max_pending episodes are waiting at any time, to keep the memory bounded.
+    :param new_podcast: generator of the new podcast episodes, like get_all_new_podcast
+    :param max_pending: maximum number of discovered episodes waiting to be consumed
+    :return: generator of the same Podcast instances in the same order, that raises the error of the discovery
+    """
+    pending = Queue(maxsize=max_pending)
+    stop = Event()
+    done = object()
+
+    def _put(item) -> bool:
+        # Wait for a free place in the queue unless the consumer stopped
+        while not stop.is_set():
+            try:
+                pending.put(item, timeout=0.5)
+                return True
+            except Full:
+                continue
+        return False
+
+    def _produce():
+        # The end is always sent, also after SystemExit or KeyboardInterrupt, so the consumer never waits forever
+        end = done
+        try:
+            for podcast in new_podcast:
+                if not _put(podcast):
+                    return
+        except BaseException as e:
+            end = e
+        finally:
+            _put(end)
+
+    Thread(target=_produce, name='discovery', daemon=True).start()
+    try:
+        while True:
+            item = pending.get()
+            if item is done:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
@@ -0,0 +1,280 @@
+import os
+from typing import BinaryIO, Union
+
+# Embedded pictures bigger than this are dropped from the ID3v2 tag, the smaller ones (like a thumbnail cover) are kept
+MAX_PICTURE_BYTES = int(os.environ.get('PODCAST_ID3_MAX_PICTURE_BYTES', 64 * 1024))
+
+TAG_HEADER_SIZE = 10
+FRAME_HEADER_SIZE = 10
+
+# ID3v2 tag header flags
+TAG_UNSYNCHRONISATION = 0x80
+TAG_EXTENDED_HEADER = 0x40
+TAG_FOOTER = 0x10
+
+# ID3v2 frame format flags (second flags byte) that change the frame body: compression, encryption, unsynchronisation
+FRAME_ENCODED_FLAGS = {3: 0xc0, 4: 0x0e}
+
+PICTURE_FRAME = b'APIC'
+CHAPTER_FRAME = b'CHAP'
+TOC_FRAME = b'CTOC'
+
+# States of the stripper, the container states are inside a CHAP or CTOC frame
+_HEADER, _EXTENDED_HEADER, _FRAMES, _TAG_END, _AUDIO, _CONTAINER_HEADER, _SUB_FRAMES, _CONTAINER_RAW = range(8)
+
+
+def _syncsafe(data: bytes) -> int:
+    return (data[0] & 0x7f) << 21 | (data[1] & 0x7f) << 14 | (data[2] & 0x7f) << 7 | data[3] & 0x7f
+
+
+def _to_syncsafe(size: int) -> bytes:
+    return bytes([size >> 21 & 0x7f, size >> 14 & 0x7f, size >> 7 & 0x7f, size & 0x7f])
+
+
+def _frame_size(data: bytes, version: int) -> int:
+    return _syncsafe(data) if version == 4 else int.from_bytes(data, 'big')
+
+
+def _to_frame_size(size: int, version: int) -> bytes:
+    return _to_syncsafe(size) if version == 4 else size.to_bytes(4, 'big')
+
+
+def _is_frame_id(frame_id: bytes) -> bool:
+    return all(48 <= c <= 57 or 65 <= c <= 90 for c in frame_id)
+
+
+class ID3Stripper:
+    """
+    Binary stream that writes an MP3 file without its big embedded pictures and without the ID3v2 padding.
+    The ID3v2 tag at the start of the file is rewritten while the file is written, in a single pass:
+    the dropped pictures are skipped without being held in memory, also inside the chapter (CHAP)
+    and table of contents (CTOC) frames, only the kept frames are held until the end of the tag.
+    The audio frames after the tag are written untouched.
+    Files without an ID3v2.3 or ID3v2.4 tag, or with an unsynchronised tag, are written as is.
+
+    Attributes:
+    - original_size (int): Number of bytes written to the stripper.
+    - size (int): Number of bytes written to the file.
+    """
+    def __init__(self, fp: BinaryIO, max_picture_bytes: int = MAX_PICTURE_BYTES):
+        """
+        :param fp: The binary file to write the stripped MP3 into
+        :param max_picture_bytes: Pictures bigger than this are dropped, also from the chapters
+        """
+        self._fp = fp
+        self._max_picture_bytes = max_picture_bytes
+        self.original_size = 0
+        self.size = 0
+        self._state = _HEADER
+        self._buffer = bytearray()
+        self._header = b''
+        self._version = 0
+        self._tag_remaining = 0
+        self._skip = 0
+        self._frames = bytearray()
+        self._container_header = b''
+        self._container_body = bytearray()
+        self._container_remaining = 0
+
+    def _write(self, data: bytes) -> None:
+        self._fp.write(data)
+        self.size += len(data)
+
+    def write(self, data: bytes) -> None:
+        self.original_size += len(data)
+        if self._state == _AUDIO:
+            self._write(data)
+            return
+        self._buffer += data
+        self._parse()
+
+    def _skip_rest_of_tag(self) -> None:
+        """
+        Drop the rest of the tag (padding or unknown data) and its footer
+        """
+        self._skip = self._tag_remaining + (TAG_HEADER_SIZE if self._header[5] & TAG_FOOTER else 0)
+        self._tag_remaining = 0
+        self._state = _TAG_END
+
+    def _is_dropped_picture(self, frame_id: bytes, frame_size: int) -> bool:
+        return frame_id == PICTURE_FRAME and frame_size > self._max_picture_bytes
+
+    def _parse(self) -> None:
+        """
+        Consume the buffered bytes of the tag as far as possible
+        """
+        buffer = self._buffer
+        while True:
+            if self._skip:
+                skipped = min(self._skip, len(buffer))
+                del buffer[:skipped]
+                self._skip -= skipped
+                if self._skip:
+                    return
+
+            if self._state == _HEADER:
+                if len(buffer) < TAG_HEADER_SIZE:
+                    return
+                header = bytes(buffer[:TAG_HEADER_SIZE])
+                if header[:3] != b'ID3' or header[3] not in (3, 4) or header[5] & TAG_UNSYNCHRONISATION:
+                    self._state = _AUDIO
+                    continue
+                del buffer[:TAG_HEADER_SIZE]
+                self._header = header
+                self._version = header[3]
+                self._tag_remaining = _syncsafe(header[6:10])
+                self._state = _EXTENDED_HEADER if header[5] & TAG_EXTENDED_HEADER else _FRAMES
+
+            elif self._state == _EXTENDED_HEADER:
+                # The extended header (CRC and restrictions) doesn't fit the rewritten tag, it's dropped
+                if len(buffer) < 4:
+                    return
+                extended_size = _syncsafe(buffer[:4]) if self._version == 4 else int.from_bytes(buffer[:4], 'big') + 4
+                self._skip = min(extended_size, self._tag_remaining)
+                self._tag_remaining -= self._skip
+                self._state = _FRAMES
+
+            elif self._state == _FRAMES:
+                if self._tag_remaining < FRAME_HEADER_SIZE or (buffer and buffer[0] == 0):
+                    self._skip_rest_of_tag()
+                    continue
+                if len(buffer) < FRAME_HEADER_SIZE:
+                    return
+                frame_id = bytes(buffer[:4])
+                frame_size = FRAME_HEADER_SIZE + _frame_size(buffer[4:8], self._version)
+                if not _is_frame_id(frame_id) or frame_size > self._tag_remaining:
+                    self._skip_rest_of_tag()
+                    continue
+                self._tag_remaining -= frame_size
+                if self._is_dropped_picture(frame_id, frame_size - FRAME_HEADER_SIZE):
+                    self._skip = frame_size
+                    continue
+                if frame_id in (CHAPTER_FRAME, TOC_FRAME) and not buffer[9] & FRAME_ENCODED_FLAGS[self._version]:
+                    # The sub-frames of the container are streamed like the frames of the tag
+                    self._container_header = bytes(buffer[:FRAME_HEADER_SIZE])
+                    self._container_remaining = frame_size - FRAME_HEADER_SIZE
+                    del buffer[:FRAME_HEADER_SIZE]
+                    self._state = _CONTAINER_HEADER
+                    continue
+                if len(buffer) < frame_size:
+                    self._tag_remaining += frame_size
+                    return
+                self._frames += buffer[:frame_size]
+                del buffer[:frame_size]
+
+            elif self._state == _CONTAINER_HEADER:
+                header_size = self._container_header_size()
+                if header_size is None:
+                    return
+                if header_size < 0:
+                    self._state = _CONTAINER_RAW
+                    continue
+                self._add_to_container(header_size)
+                self._state = _SUB_FRAMES
+
+            elif self._state == _SUB_FRAMES:
+                if not self._container_remaining:
+                    self._end_container()
+                    continue
+                if self._container_remaining < FRAME_HEADER_SIZE or (buffer and buffer[0] == 0):
+                    self._state = _CONTAINER_RAW
+                    continue
+                if len(buffer) < FRAME_HEADER_SIZE:
+                    return
+                frame_id = bytes(buffer[:4])
+                frame_size = FRAME_HEADER_SIZE + _frame_size(buffer[4:8], self._version)
+                if not _is_frame_id(frame_id) or frame_size > self._container_remaining:
+                    self._state = _CONTAINER_RAW
+                    continue
+                if self._is_dropped_picture(frame_id, frame_size - FRAME_HEADER_SIZE):
+                    self._container_remaining -= frame_size
+                    self._skip = frame_size
+                    continue
+                if len(buffer) < frame_size:
+                    return
+                self._add_to_container(frame_size)
+
+            elif self._state == _CONTAINER_RAW:
+                # The rest of a container that can't be parsed is kept as is
+                if self._container_remaining and not buffer:
+                    return
+                self._add_to_container(min(self._container_remaining, len(buffer)))
+                if not self._container_remaining:
+                    self._end_container()
+
+            elif self._state == _TAG_END:
+                self._write_tag()
+                self._state = _AUDIO
+
+            else:
+                self._write(bytes(buffer))
+                buffer.clear()
+                return
+
+    def _container_header_size(self) -> Union[int, None]:
+        """
+        Size of the container fields before its sub-frames: the element ID and the times and offsets of a chapter,
+        or the element ID, flags and child element IDs of a table of contents
+        :return: the size, None if more bytes are needed, -1 if the container can't be parsed
+        """
+        buffer = self._buffer
+        limit = self._container_remaining
+        position = buffer.find(b'\0', 0, limit)
+        if position < 0:
+            return -1 if len(buffer) >= limit else None
+        position += 1
+        if self._container_header[:4] == CHAPTER_FRAME:
+            position += 16
+        else:
+            if position + 2 > limit:
+                return -1
+            if len(buffer) < position + 2:
+                return None
+            entries_count = buffer[position + 1]
+            position += 2
+            for _ in range(entries_count):
+                child_end = buffer.find(b'\0', position, limit)
+                if child_end < 0:
+                    return -1 if len(buffer) >= limit else None
+                position = child_end + 1
+        if position > limit:
+            return -1
+        return position if len(buffer) >= position else None
+
+    def _add_to_container(self, size: int) -> None:
+        self._container_body += self._buffer[:size]
+        del self._buffer[:size]
+        self._container_remaining -= size
+
+    def _end_container(self) -> None:
+        """
+        Add the container frame with its new size to the kept frames
+        """
+        header = self._container_header
+        self._frames += header[:4] + _to_frame_size(len(self._container_body), self._version) + header[8:10]
+        self._frames += self._container_body
+        self._container_body = bytearray()
+        self._state = _FRAMES
+
+    def _write_tag(self) -> None:
+        """
+        Write the rewritten tag, without padding, footer and extended header
+        """
+        flags = self._header[5] & ~(TAG_EXTENDED_HEADER | TAG_FOOTER)
+        self._write(self._header[:5] + bytes([flags]) + _to_syncsafe(len(self._frames)))
+        self._write(bytes(self._frames))
+        self._frames.clear()
+
+    def close(self) -> None:
+        """
+        Write what is left when the file ended inside the tag
+        """
+        if self._state == _HEADER:
+            self._write(bytes(self._buffer))
+        elif self._state != _AUDIO:
+            if self._state in (_CONTAINER_HEADER, _SUB_FRAMES, _CONTAINER_RAW):
+                self._end_container()
+            self._write_tag()
+            self._write(bytes(self._buffer))
+        self._buffer.clear()
+        self._state = _AUDIO
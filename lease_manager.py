@@ -0,0 +1,57 @@
+import os
+import socket
+import uuid
+from threading import Thread, Event
+from db_manager import DatabaseManager
+from logging_manager import loger
+
+# Unique ID of this worker process, used as the owner of the leases it takes
+WORKER_ID = f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}'
+
+# Lease time in seconds, the heartbeat renews the leases three times in each period
+LEASE_TTL = int(os.environ.get('PODCAST_LEASE_TTL', 300))
+
+
+class LeaseHeartbeat:
+    """
+    Renews all the leases held by a worker in a background thread, so long downloads and uploads
+    don't lose their feed and episode leases while the worker is alive.
+
+    Attributes:
+    - _db (DatabaseManager): Database manager that stores the leases.
+    - _owner (str): ID of the worker.
+    - _ttl (int): Lease time in seconds.
+    """
+    def __init__(self, db: DatabaseManager, owner: str = WORKER_ID, ttl: int = LEASE_TTL):
+        """
+        Init the heartbeat, call start() to run it.
+        :param db: Database manager that stores the leases
+        :param owner: ID of the worker
+        :param ttl: Lease time in seconds
+        """
+        self._db = db
+        self._owner = owner
+        self._ttl = ttl
+        self._stop = Event()
+        self._thread = Thread(target=self._run, name='lease-heartbeat', daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self._ttl / 3):
+            try:
+                self._db.renew_leases(self._owner, self._ttl)
+            except Exception as e:
+                loger.error(f'failed to renew the leases of {self._owner}: {e}')
+
+    def start(self) -> 'LeaseHeartbeat':
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def __enter__(self) -> 'LeaseHeartbeat':
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
@@ -16,7 +16,9 @@ loger = logging.getLogger(__name__)
 
 loger.setLevel(logging.DEBUG)
 
-log_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'log')
+# The run logs directory, the log directory of the project unless PODCAST_LOG_DIR is set
+log_dir = os.environ.get('PODCAST_LOG_DIR') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'log')
+os.makedirs(log_dir, exist_ok=True)
 
 log_number = str(len([log for log in os.listdir(log_dir) if log.endswith('log')]) + 1)
 handler = logging.FileHandler(f'{log_dir}/{log_number}-{datetime.now().strftime("%H_%M_%S-%d_%m_%Y")}.log',
@@ -0,0 +1,35 @@
+import os
+from time import monotonic
+
+# Time budget in seconds of one run, after it no new feed or episode is started (0 for no limit)
+RUN_DEADLINE = float(os.environ.get('PODCAST_RUN_DEADLINE', 45 * 60))
+
+
+class RunDeadline:
+    """
+    The time budget of a run. The stages check it before starting new work,
+    the work already in-flight is finished.
+
+    Attributes:
+    - _expires_at (float | None): monotonic time of the deadline, None for no limit.
+    """
+    def __init__(self, seconds: float = RUN_DEADLINE):
+        """
+        Start the run budget from now
+        :param seconds: The time budget in seconds, 0 or less for no limit
+        """
+        self._expires_at = monotonic() + seconds if seconds > 0 else None
+
+    def remaining(self) -> float:
+        """
+        :return: seconds until the deadline, infinity if there is no limit
+        """
+        if self._expires_at is None:
+            return float('inf')
+        return max(self._expires_at - monotonic(), 0.0)
+
+    def expired(self) -> bool:
+        """
+        :return: True if no new work should be started
+        """
+        return self.remaining() <= 0
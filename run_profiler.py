@@ -0,0 +1,332 @@
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Callable, Iterator, Union
+from logging_manager import loger, handler
+
+# Profile the stages of the run when set to 1 (or by app.py --profile)
+PROFILE = os.environ.get('PODCAST_PROFILE', '0') == '1'
+
+# Seconds between the wall-clock samples of the profiled threads
+PROFILE_SAMPLE_INTERVAL = float(os.environ.get('PODCAST_PROFILE_SAMPLE_INTERVAL', 0.01))
+
+# Number of allocation sites in the allocations summary of each stage
+TOP_ALLOCATIONS = 25
+
+# Since Python 3.12 cProfile uses the single process-wide sys.monitoring profiler, so only one profile could be
+# enabled at a time. Then one profile of the whole run (all threads) is written instead of a profile of each stage
+PROFILE_EACH_STAGE = sys.version_info < (3, 12)
+
+# A waiting thread whose top Python frame is in one of these files waits for the network
+NETWORK_FILES = ('socket.py', 'ssl.py', 'selectors.py')
+
+# Breakdown of the sampled wall-clock time of a stage
+CPU, NETWORK_WAIT, OTHER_WAIT = 'cpu', 'network wait', 'other wait'
+
+
+class _Stage:
+    """
+    Profiling data of one stage.
+
+    Attributes:
+    - name (str): The stage name.
+    - profiles (dict[int, Profile]): cProfile of each thread that ran the stage.
+    - start_time, end_time (float): Wall-clock time of the stage start and end.
+    - start_snapshot, end_snapshot (Snapshot): tracemalloc snapshots of the stage start and end.
+    - samples (dict[str, float]): Sampled seconds of CPU, network wait and other wait.
+    """
+    def __init__(self, name: str):
+        self.name = name
+        self.profiles = {}
+        self.start_time = None
+        self.end_time = None
+        self.start_snapshot = None
+        self.end_snapshot = None
+        self.samples = {CPU: 0.0, NETWORK_WAIT: 0.0, OTHER_WAIT: 0.0}
+
+
+class RunProfiler:
+    """
+    Profiles the stages of a run (discovery, transfer, render, send), also when a stage runs in several threads.
+    Each thread of a stage has its own cProfile that is merged into one .prof file of the stage
+    (one run.prof of all the stages unless PROFILE_EACH_STAGE),
+    tracemalloc snapshots at the stage start and end give its top allocations,
+    and a sampler thread splits the wall-clock time of the stage threads into CPU, network wait and other wait.
+    The output is written next to the run log file.
+
+    Attributes:
+    - output_dir (str): Directory of the profiling output.
+    - _stages (dict[str, _Stage]): The stages by name.
+    - _thread_stages (dict[int, list[str]]): Stack of the running stages of each thread.
+    - _local (threading.local): Stack of the enabled cProfiles of the current thread.
+    """
+    def __init__(self, output_dir: str = None, sample_interval: float = PROFILE_SAMPLE_INTERVAL,
+                 profile_each_stage: bool = PROFILE_EACH_STAGE):
+        """
+        :param output_dir: Directory of the output, defaults to <log file name>-profile next to the log file
+        :param sample_interval: Seconds between the wall-clock samples
+        :param profile_each_stage: cProfile each stage apart, otherwise one cProfile of the whole run
+        """
+        self._profile_each_stage = profile_each_stage
+        self._run_profile = None
+        self.output_dir = output_dir or f'{os.path.splitext(handler.baseFilename)[0]}-profile'
+        self._sample_interval = sample_interval
+        self._stages = {}
+        self._thread_stages = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sampler = None
+
+    def start(self) -> None:
+        """
+        Start tracing the allocations and sampling the stage threads
+        """
+        import cProfile
+        import tracemalloc
+        if not self._profile_each_stage:
+            self._run_profile = cProfile.Profile()
+            self._run_profile.enable()
+        tracemalloc.start()
+        self._sampler = threading.Thread(target=self._sample, name='profile-sampler', daemon=True)
+        self._sampler.start()
+
+    def _get_stage(self, name: str) -> _Stage:
+        with self._lock:
+            if name not in self._stages:
+                self._stages[name] = _Stage(name)
+            return self._stages[name]
+
+    @staticmethod
+    def _snapshot():
+        """
+        :return: tracemalloc snapshot without the allocations of the profiling itself
+        """
+        import tracemalloc
+        return tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__),
+                                                          tracemalloc.Filter(False, __file__)])
+
+    def _begin(self, stage: _Stage) -> None:
+        with self._lock:
+            if stage.start_time is not None:
+                return
+            stage.start_time = time.time()
+        stage.start_snapshot = self._snapshot()
+
+    def _end(self, stage: _Stage) -> None:
+        stage.end_time = time.time()
+        stage.end_snapshot = self._snapshot()
+
+    @contextmanager
+    def _profile_thread(self, stage: _Stage):
+        """
+        Profile the current thread as part of the stage.
+        A stage inside another stage of the same thread pauses the outer stage profile.
+        """
+        import cProfile
+        ident = threading.get_ident()
+        if not self._profile_each_stage:
+            self._thread_stages.setdefault(ident, []).append(stage.name)
+            try:
+                yield
+            finally:
+                self._thread_stages[ident].pop()
+            return
+        profile = stage.profiles.get(ident)
+        if profile is None:
+            profile = stage.profiles[ident] = cProfile.Profile()
+        enabled = getattr(self._local, 'profiles', None)
+        if enabled is None:
+            enabled = self._local.profiles = []
+        if enabled:
+            enabled[-1].disable()
+        enabled.append(profile)
+        self._thread_stages.setdefault(ident, []).append(stage.name)
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            enabled.pop()
+            self._thread_stages[ident].pop()
+            if enabled:
+                enabled[-1].enable()
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Profile a stage that runs in the current thread, from its start to its end
+        :param name: The stage name
+        """
+        stage = self._get_stage(name)
+        self._begin(stage)
+        try:
+            with self._profile_thread(stage):
+                yield
+        finally:
+            self._end(stage)
+
+    def profiled(self, name: str, func: Callable) -> Callable:
+        """
+        Wrap a function that runs part of a stage, like a task of a worker thread
+        :param name: The stage name
+        :param func: The function to profile
+        :return: the wrapped function
+        """
+        stage = self._get_stage(name)
+
+        def _profiled(*args, **kwargs):
+            self._begin(stage)
+            with self._profile_thread(stage):
+                return func(*args, **kwargs)
+        return _profiled
+
+    def profiled_iter(self, name: str, iterator: Iterator) -> Iterator:
+        """
+        Wrap a lazy iterator, so only its own work is profiled as the stage, in the thread that consumes it
+        :param name: The stage name
+        :param iterator: The iterator to profile, like a generator of a stage
+        :return: generator of the same items
+        """
+        stage = self._get_stage(name)
+        iterator = iter(iterator)
+        try:
+            while True:
+                self._begin(stage)
+                with self._profile_thread(stage):
+                    try:
+                        item = next(iterator)
+                    except StopIteration:
+                        return
+                yield item
+        finally:
+            self._end(stage)
+
+    def _sample(self) -> None:
+        """
+        Sample the threads that run a stage: the CPU time of each thread since the last sample is CPU,
+        the rest of the wall-clock time is network wait or other wait, by the top Python frame of the thread
+        """
+        cpu_times = {}
+        last_time = time.monotonic()
+        while not self._stop.wait(self._sample_interval):
+            now = time.monotonic()
+            interval = now - last_time
+            last_time = now
+            frames = sys._current_frames()
+            for ident, stage_names in list(self._thread_stages.items()):
+                if not stage_names or ident not in frames:
+                    cpu_times.pop(ident, None)
+                    continue
+                stage = self._stages[stage_names[-1]]
+                try:
+                    cpu_time = time.clock_gettime(time.pthread_getcpuclockid(ident))
+                except (AttributeError, OSError):
+                    cpu_time = None
+                last_cpu_time = cpu_times.get(ident)
+                cpu_times[ident] = cpu_time
+                if cpu_time is None or last_cpu_time is None:
+                    continue
+                cpu = min(max(cpu_time - last_cpu_time, 0.0), interval)
+                file_name = os.path.basename(frames[ident].f_code.co_filename)
+                stage.samples[CPU] += cpu
+                stage.samples[NETWORK_WAIT if file_name in NETWORK_FILES else OTHER_WAIT] += interval - cpu
+
+    def _write_stage(self, stage: _Stage) -> str:
+        """
+        Write the .prof file and the top allocations of a stage
+        :return: one line summary of the stage
+        """
+        import pstats
+        profiles = list(stage.profiles.values())
+        if profiles:
+            stats = pstats.Stats(profiles[0])
+            for profile in profiles[1:]:
+                stats.add(profile)
+            stats.dump_stats(os.path.join(self.output_dir, f'{stage.name}.prof'))
+
+        wall_time = (stage.end_time or time.time()) - stage.start_time
+        with open(os.path.join(self.output_dir, f'{stage.name}-allocations.txt'), 'w', encoding='utf-8') as f:
+            f.write(f'stage: {stage.name}, wall time: {wall_time:.2f} seconds, threads: {len(profiles)}\n')
+            f.write(f'top {TOP_ALLOCATIONS} allocation sites between the stage start and end '
+                    f'(other stages running meanwhile are included):\n')
+            if stage.start_snapshot is not None and stage.end_snapshot is not None:
+                for statistic in stage.end_snapshot.compare_to(stage.start_snapshot, 'lineno')[:TOP_ALLOCATIONS]:
+                    f.write(f'{statistic}\n')
+
+        sampled_time = sum(stage.samples.values()) or 1
+        return f'{stage.name}: wall {wall_time:.2f}s, ' + ', '.join(
+            f'{kind} {seconds:.2f}s ({seconds / sampled_time:.0%})' for kind, seconds in stage.samples.items())
+
+    def stop(self) -> None:
+        """
+        Stop the profiling and write the output of all the stages
+        """
+        import tracemalloc
+        self._stop.set()
+        if self._sampler is not None:
+            self._sampler.join()
+        if self._run_profile is not None:
+            self._run_profile.disable()
+        for stage in self._stages.values():
+            if stage.start_time is not None and stage.end_snapshot is None:
+                self._end(stage)
+        tracemalloc.stop()
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        if self._run_profile is not None:
+            self._run_profile.dump_stats(os.path.join(self.output_dir, 'run.prof'))
+        summary = [self._write_stage(stage) for stage in self._stages.values() if stage.start_time is not None]
+        with open(os.path.join(self.output_dir, 'breakdown.txt'), 'w', encoding='utf-8') as f:
+            f.write('sampled thread time of each stage, a stage with several threads could exceed its wall time\n')
+            f.write('\n'.join(summary) + '\n')
+        loger.info('profile of the run stages:\n' + '\n'.join(summary) + f'\noutput in: {self.output_dir}')
+
+
+# The profiler of this run, None unless profiling is enabled
+_profiler: Union[RunProfiler, None] = None
+
+
+def start(output_dir: str = None) -> RunProfiler:
+    """
+    Enable the profiling of the run stages
+    :param output_dir: Directory of the output, defaults to next to the run log file
+    :return: The run profiler
+    """
+    global _profiler
+    _profiler = RunProfiler(output_dir)
+    _profiler.start()
+    return _profiler
+
+
+def stop() -> None:
+    """
+    Write the profiling output, if the profiling is enabled
+    """
+    global _profiler
+    if _profiler is not None:
+        _profiler.stop()
+        _profiler = None
+
+
+def stage(name: str):
+    """
+    Context manager that profiles a stage in the current thread, does nothing unless the profiling is enabled
+    """
+    return _profiler.stage(name) if _profiler is not None else nullcontext()
+
+
+def profiled(name: str, func: Callable) -> Callable:
+    """
+    Profile a function as part of a stage, the function is returned as is unless the profiling is enabled
+    """
+    return _profiler.profiled(name, func) if _profiler is not None else func
+
+
+def profiled_iter(name: str, iterator: Iterator) -> Iterator:
+    """
+    Profile a lazy iterator as part of a stage, the iterator is returned as is unless the profiling is enabled
+    """
+    return _profiler.profiled_iter(name, iterator) if _profiler is not None else iterator
@@ -1,16 +1,25 @@
 # TODO: all email sending manage will be move to difference server that will take care about subscribers
 #  and send / receive emails
+import os
 import smtplib
+from collections import Counter
+from email.mime.multipart import MIMEMultipart
 from logging_manager import loger
 from db_manager import DatabaseManager
 from db_schema import PodcastFiles
-from private_conf import private_conf
-from typing import Type, List
+from create_email_message import write_message, discard_podcast_fragments, create_mail_messages
+from digest_planner import Digest
+import run_profiler
+from typing import Type, List, Iterator
 
+# Size of the buffer written to the SMTP socket at once
+SMTP_WRITE_BUFFER = 64 * 1024
 
-def get_all_subscribers(db: DatabaseManager):
-    all_subscribers = [subscriber.email for subscriber in db.fetch_subscribers()]
-    return all_subscribers
+# Timeout in seconds of each SMTP socket operation
+SMTP_TIMEOUT = 60
+
+# Maximum recipients of one sent message, a bigger group gets the same message in several batches
+RECIPIENTS_BATCH = int(os.environ.get('PODCAST_EMAIL_RECIPIENTS_BATCH', 100))
 
 
 def update_sent_podcast(sent_podcast: List[Type[PodcastFiles]], db: DatabaseManager):
@@ -19,7 +28,94 @@ def update_sent_podcast(sent_podcast: List[Type[PodcastFiles]], db: DatabaseMana
         db.update_sent(podcast_id)
 
 
-def send_email(db, message, new_podcast: List[Type[PodcastFiles]]):
+class _SMTPDataStream:
+    """
+    Binary stream that writes the message into the SMTP socket during the DATA command,
+    with dot-stuffing of lines that start with a dot.
+    """
+    def __init__(self, sock):
+        self._sock = sock
+        self._buffer = bytearray()
+        self._line_start = True
+
+    def write(self, data: bytes) -> None:
+        if not data:
+            return
+        data = data.replace(b'\n.', b'\n..')
+        if self._line_start and data.startswith(b'.'):
+            data = b'.' + data
+        self._line_start = data.endswith(b'\n')
+        self._buffer += data
+        if len(self._buffer) >= SMTP_WRITE_BUFFER:
+            self.flush()
+
+    def flush(self) -> None:
+        self._sock.sendall(self._buffer)
+        self._buffer.clear()
+
+    def close(self) -> None:
+        """
+        Write the end of data mark and flush the buffer
+        """
+        self._buffer += b'.\r\n' if self._line_start else b'\r\n.\r\n'
+        self.flush()
+
+
+def _send_message(server: smtplib.SMTP, sender: str, recipients: List[str], message: MIMEMultipart) -> dict:
+    """
+    Send one message, like SMTP.sendmail but the message is streamed into the socket
+    instead of creating it as one string.
+    :param server: Connected SMTP server
+    :param sender: The sender email address
+    :param recipients: The recipients email addresses
+    :param message: The email message
+    :return: dict of the refused recipients, like SMTP.sendmail
+    """
+    server.ehlo_or_helo_if_needed()
+    code, response = server.mail(sender)
+    if code != 250:
+        server.rset()
+        raise smtplib.SMTPSenderRefused(code, response, sender)
+    refused = {}
+    for recipient in recipients:
+        code, response = server.rcpt(recipient)
+        if code not in (250, 251):
+            refused[recipient] = (code, response)
+    if len(refused) == len(recipients):
+        server.rset()
+        raise smtplib.SMTPRecipientsRefused(refused)
+
+    code, response = server.docmd('data')
+    if code != 354:
+        server.rset()
+        raise smtplib.SMTPDataError(code, response)
+    stream = _SMTPDataStream(server.sock)
+    write_message(message, stream)
+    stream.close()
+    code, response = server.getreply()
+    if code != 250:
+        raise smtplib.SMTPDataError(code, response)
+    return refused
+
+
+def _recipients_batches(recipients: List[str], batch_size: int) -> Iterator[List[str]]:
+    for i in range(0, len(recipients), batch_size):
+        yield recipients[i:i + batch_size]
+
+
+def send_email(db, digests: List[Digest], recipients_batch: int = RECIPIENTS_BATCH):
+    """
+    Send the digests over one SMTP connection. Each digest is rendered once and sent to its recipients in batches.
+    An episode is marked as sent right after the last message that contains it is sent to all its recipients.
+    The delivery is at least once: if a message fails, its episodes stay unsent and are sent again on the next run
+    in whole digests, also to the recipients that already got them (earlier recipient batches or other digests).
+    :param db: Database manager to update the sent episodes
+    :param digests: The distinct digests with their recipients, like plan_digests
+    :param recipients_batch: Maximum recipients of one sent message
+    :return: True if all messages sent
+    """
+    from private_conf import private_conf
+
     sender_email = private_conf['sender_email_address']
     sender_password = private_conf['sender_email_password']
     subject = 'פודקאסטים חדשים'
@@ -27,17 +123,28 @@ def send_email(db, message, new_podcast: List[Type[PodcastFiles]]):
     smtp_server = 'smtp.gmail.com'
     smtp_port = 587
 
-    message['From'] = sender_email
-    message['Subject'] = subject
-    subscribers = get_all_subscribers(db)
+    # Number of digests that still have to send each episode
+    unsent_digests = Counter(podcast.id for digest in digests for podcast in digest.podcast)
 
     try:
-        with smtplib.SMTP(smtp_server, smtp_port) as server:
+        with smtplib.SMTP(smtp_server, smtp_port, timeout=SMTP_TIMEOUT) as server:
             server.starttls()
             server.login(sender_email, sender_password)
-            server.sendmail(sender_email, subscribers, message.as_string())
+            for digest_number, digest in enumerate(digests, start=1):
+                messages = run_profiler.profiled_iter('render', create_mail_messages(digest.podcast))
+                for part_number, (message, new_podcast) in enumerate(messages, start=1):
+                    message['From'] = sender_email
+                    message['Subject'] = subject if part_number == 1 else f'{subject} ({part_number})'
+                    for recipients in _recipients_batches(digest.recipients, recipients_batch):
+                        _send_message(server, sender_email, recipients, message)
+
+                    unsent_digests.subtract(podcast.id for podcast in new_podcast)
+                    sent_podcast = [podcast for podcast in new_podcast if unsent_digests[podcast.id] == 0]
+                    update_sent_podcast(sent_podcast, db)
+                    discard_podcast_fragments(sent_podcast)
+                    loger.info(f'digest {digest_number} part {part_number} with {len(new_podcast)} podcast '
+                               f'sent to {len(digest.recipients)} subscribers')
         print("Email sent successfully.")
-        update_sent_podcast(new_podcast, db)
         return True
     except Exception as e:
         print(f"An error occurred: {str(e)}")
@@ -0,0 +1,83 @@
+import os
+import pytest
+import re
+import shutil
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+
+# The run logs of the tests (and of their worker processes) are written out of the project log directory,
+# before logging_manager is imported by the tested modules
+os.environ['PODCAST_LOG_DIR'] = tempfile.mkdtemp(prefix='podcast-test-log-')
+
+
+def pytest_unconfigure(config):
+    shutil.rmtree(os.environ['PODCAST_LOG_DIR'], ignore_errors=True)
+
+
+def create_rss(items_count: int, feed_name: str = '') -> bytes:
+    """
+    Create an RSS feed with the given number of items, the newest item first
+    """
+    start_date = datetime(2024, 1, 1, 12, 0, tzinfo=timezone.utc)
+    items = ''.join(
+        f'<item><title>episode {i}</title><guid isPermaLink="false">episode-{i}</guid>'
+        f'<pubDate>{format_datetime(start_date - timedelta(days=i))}</pubDate>'
+        f'<description><![CDATA[<p>description of episode {i}</p>]]></description>'
+        f'<enclosure url="https://example.com/{feed_name}episode-{i}.mp3" type="audio/mpeg" length="1000"/></item>'
+        for i in range(items_count)
+    )
+    return (f'<?xml version="1.0" encoding="UTF-8"?><rss version="2.0"><channel><title>test podcast</title>'
+            f'{items}</channel></rss>').encode('utf-8')
+
+
+@pytest.fixture(scope='session')
+def rss_server():
+    """
+    Local RSS server: /big.rss has 5000 items, /broken.rss is malformed, /error.rss fails,
+    /nodate.rss has an item without a published date,
+    /slow.rss sends a small feed one byte every 0.1 seconds
+    and /feed/<name>.rss is a small feed with episodes links unique to the name,
+    /delayed/<name>.rss is the same feed sent after 0.2 seconds of server latency
+    """
+    feeds = {'/big.rss': create_rss(5000), '/broken.rss': create_rss(10)[:-300] + b'<item><title>',
+             '/nodate.rss': re.sub(rb'(episode-1</guid>)<pubDate>.*?</pubDate>', rb'\1', create_rss(3))}
+
+    class FeedHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == '/error.rss':
+                self.send_error(503)
+                return
+            if self.path.startswith('/delayed/'):
+                time.sleep(0.2)
+                body = create_rss(10, self.path[len('/delayed/'):-len('.rss')] + '/')
+            elif self.path.startswith('/feed/') or self.path == '/slow.rss':
+                body = create_rss(10, self.path[len('/feed/'):-len('.rss')] + '/')
+            else:
+                body = feeds[self.path]
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/rss+xml')
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('ETag', '"test-etag"')
+            self.end_headers()
+            try:
+                if self.path == '/slow.rss':
+                    for i in range(len(body)):
+                        self.wfile.write(body[i:i + 1])
+                        self.wfile.flush()
+                        time.sleep(0.1)
+                else:
+                    self.wfile.write(body)
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FeedHandler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_port}'
+    server.shutdown()
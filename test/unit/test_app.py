@@ -0,0 +1,42 @@
+import os
+import subprocess
+import sys
+
+# Cumulative import time budget (in microseconds) of app.py on the no-newz path
+IMPORT_TIME_BUDGET_US = 1_500_000
+
+# Modules that belong to the transfer and email stages and must not be loaded at startup
+HEAVY_MODULES = ['googleapiclient', 'google.oauth2', 'eyed3', 'premailer', 'lxml', 'jinja2',
+                 'bs4', 'dicttoxml', 'requests', 'files_manager', 'create_email_message', 'send_email',
+                 'private_conf']
+
+
+def _import_app_times() -> dict[str, int]:
+    """
+    Import app.py in a fresh interpreter with -X importtime
+    :return: dict of module name to its cumulative import time in microseconds
+    """
+    project_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    os.makedirs(os.path.join(project_dir, 'log'), exist_ok=True)
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import app'],
+                            cwd=project_dir, capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+    import_times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, module = line.split('|')
+        import_times[module.strip()] = int(cumulative)
+    return import_times
+
+
+def test_app_startup_skip_heavy_modules():
+    import_times = _import_app_times()
+    loaded_heavy = [module for module in import_times
+                    if any(module == heavy or module.startswith(heavy + '.') for heavy in HEAVY_MODULES)]
+    assert loaded_heavy == []
+
+
+def test_app_startup_import_time_budget():
+    import_times = _import_app_times()
+    assert import_times['app'] < IMPORT_TIME_BUDGET_US
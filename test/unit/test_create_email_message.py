@@ -0,0 +1,85 @@
+from datetime import datetime
+from types import SimpleNamespace
+from email import message_from_bytes
+from io import BytesIO
+import pytest
+import create_email_message
+
+
+@pytest.fixture(autouse=True)
+def fragments_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(create_email_message, 'FRAGMENTS_CACHE_DIR', str(tmp_path / 'fragments'))
+    return tmp_path / 'fragments'
+
+
+@pytest.fixture
+def new_podcast():
+    shows = [SimpleNamespace(image_id=f'image-{i}', title=f'show {i}', image=bytes([i]) * 200_000) for i in range(3)]
+    return [SimpleNamespace(id=i, podcast_id=i % 3, podcast=shows[i % 3], drive_link=f'https://drive/{i}',
+                            name=f'episode {i}', description='<p>description</p>' * 20, duration=3600,
+                            size=str(50 * 1024 ** 2), published_date=datetime(2024, 1, 1))
+            for i in range(12)]
+
+
+def _image_ids(message) -> list[str]:
+    return [part['Content-ID'] for part in message.walk() if part.get_content_maintype() == 'image']
+
+
+def test_create_mail_messages_split_by_size(new_podcast):
+    max_bytes = 700_000
+    messages = list(create_email_message.create_mail_messages(new_podcast, max_bytes=max_bytes, max_episodes=30))
+
+    assert len(messages) > 1
+    assert [podcast.id for _, podcast_part in messages for podcast in podcast_part] == list(range(12))
+    for message, podcast_part in messages:
+        assert create_email_message.message_size(message) <= max_bytes
+
+        # Only the images of the message episodes, each one once, and the logo
+        image_ids = _image_ids(message)
+        assert sorted(image_ids) == sorted({f'<{podcast.podcast.image_id}>' for podcast in podcast_part} |
+                                           {'<logo.jpg>'})
+
+
+def test_create_mail_messages_split_by_episodes(new_podcast):
+    messages = list(create_email_message.create_mail_messages(new_podcast, max_bytes=10 ** 8, max_episodes=5))
+    assert [len(podcast_part) for _, podcast_part in messages] == [5, 5, 2]
+
+
+def test_write_message(new_podcast):
+    message = create_email_message.create_mail_message(new_podcast[:2])
+    fp = BytesIO()
+    create_email_message.write_message(message, fp)
+    data = fp.getvalue()
+    assert len(data) == create_email_message.message_size(message)
+    assert b'\r\n' in data and b'\n' not in data.replace(b'\r\n', b'')
+    assert _image_ids(message_from_bytes(data)) == _image_ids(message)
+
+
+def test_podcast_fragment_rendered_once(new_podcast, fragments_cache, monkeypatch):
+    fragment = create_email_message.cache_podcast_fragment(new_podcast[0])
+    assert 'style=' in fragment and 'episode 0' in fragment
+    assert len(list(fragments_cache.iterdir())) == 1
+
+    # The digest only reads the cached fragment
+    monkeypatch.setattr(create_email_message, 'transform', None)
+    monkeypatch.setattr(create_email_message, '_create_podcast_box', None)
+    html = create_email_message._create_html_message(new_podcast[:1])
+    assert fragment in html
+
+    create_email_message.discard_podcast_fragments(new_podcast[:1])
+    assert list(fragments_cache.iterdir()) == []
+
+
+def test_podcast_fragment_invalidated_by_templates(new_podcast, fragments_cache, monkeypatch):
+    create_email_message.cache_podcast_fragment(new_podcast[0])
+    templates_hash = create_email_message._templates_hash()
+    monkeypatch.setattr(create_email_message, '_templates_hash', lambda: 'new-templates')
+
+    fragment = create_email_message.get_podcast_fragment(new_podcast[0])
+    assert 'episode 0' in fragment
+    assert sorted(path.name.split('-', 1)[1] for path in fragments_cache.iterdir()) == \
+        sorted([f'{templates_hash}.html', 'new-templates.html'])
+
+    # The fragments of the old templates are discarded too
+    create_email_message.discard_podcast_fragments(new_podcast[:1])
+    assert list(fragments_cache.iterdir()) == []
@@ -0,0 +1,208 @@
+import os
+import subprocess
+import sys
+import pytest
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from sqlalchemy import create_engine, inspect, text
+import db_manager
+from db_manager import DatabaseManager
+from db_schema import RssPodcast, PodcastFiles
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Worker process: wait for all workers to be ready, discover the new episodes and "transfer" each one
+# in 0.1 seconds, then print the work start and end times
+WORKER_SCRIPT = '''
+import os
+import sys
+import time
+from datetime import date
+from db_manager import DatabaseManager
+from files_manager import FilesManager
+from get_new_podcast import get_all_new_podcast
+from lease_manager import LeaseHeartbeat
+
+
+class SleepFilesManager(FilesManager):
+    def _transfer_podcast(self, podcast):
+        time.sleep(0.1)
+        self._db.insert_podcast_file(podcast.podcast_id, 'drive', podcast.source_link, podcast.name,
+                                     podcast.description, 1000, 1, podcast.published_date)
+        return True
+
+
+db_uri, barrier_dir, workers_count = sys.argv[1], sys.argv[2], int(sys.argv[3])
+db = DatabaseManager(db_uri)
+open(os.path.join(barrier_dir, str(os.getpid())), 'w').close()
+while len(os.listdir(barrier_dir)) < workers_count:
+    time.sleep(0.01)
+
+start_time = time.time()
+with LeaseHeartbeat(db):
+    SleepFilesManager(get_all_new_podcast(db, date(2000, 1, 1)), db, transfer_workers=1).get_all_podcast()
+print(start_time, time.time())
+'''
+
+
+@pytest.fixture
+def db_uri(tmp_path):
+    return f'sqlite:///{tmp_path}/podcast.db'
+
+
+def _add_feeds(db_uri: str, rss_server: str, feeds_count: int, feeds_path: str = 'feed') -> DatabaseManager:
+    db = DatabaseManager(db_uri)
+    session = db._Session()
+    for i in range(feeds_count):
+        session.add(RssPodcast(rss_link=f'{rss_server}/{feeds_path}/{i}.rss', title=f'feed {i}', image_id=str(i),
+                               last_newz_id='episode-2'))
+    session.commit()
+    session.close()
+    return db
+
+
+def _run_workers(db_uri: str, barrier_dir: str, workers_count: int) -> float:
+    """
+    Run worker processes on the same database
+    :return: the work time from the first worker start to the last worker end, without the interpreter startup
+    """
+    os.makedirs(barrier_dir)
+    workers = [subprocess.Popen([sys.executable, '-c', WORKER_SCRIPT, db_uri, barrier_dir, str(workers_count)],
+                                cwd=PROJECT_DIR, stdout=subprocess.PIPE, text=True)
+               for _ in range(workers_count)]
+    work_times = []
+    for worker in workers:
+        output, _ = worker.communicate(timeout=120)
+        assert worker.returncode == 0
+        work_times.append([float(work_time) for work_time in output.split()])
+    return max(end for _, end in work_times) - min(start for start, _ in work_times)
+
+
+def test_lease(db_uri):
+    db = DatabaseManager(db_uri)
+    assert db.acquire_lease('rss:1', 'worker-1', 60)
+    assert db.acquire_lease('rss:1', 'worker-1', 60)
+    assert not db.acquire_lease('rss:1', 'worker-2', 60)
+    assert db.renew_leases('worker-1', 60) == 1
+
+    # An expired lease could be taken by another worker
+    assert db.acquire_lease('rss:2', 'worker-1', -1)
+    assert db.acquire_lease('rss:2', 'worker-2', 60)
+
+    db.release_lease('rss:1', 'worker-1')
+    assert db.acquire_lease('rss:1', 'worker-2', 60)
+
+
+def test_workers_split_feeds(tmp_path, rss_server):
+    feeds_count = 16
+    single_uri = f'sqlite:///{tmp_path}/single.db'
+    multi_uri = f'sqlite:///{tmp_path}/multi.db'
+    # The feeds have server latency, so the work of each feed is mostly waiting, like the real network
+    _add_feeds(single_uri, rss_server, feeds_count, 'delayed')
+    multi_db = _add_feeds(multi_uri, rss_server, feeds_count, 'delayed')
+
+    single_time = _run_workers(single_uri, f'{tmp_path}/single', 1)
+    multi_time = _run_workers(multi_uri, f'{tmp_path}/multi', 4)
+    print(f'\n{feeds_count} feeds: 1 worker {single_time:.2f} seconds, 4 workers {multi_time:.2f} seconds, '
+          f'speedup {single_time / multi_time:.1f}x')
+
+    # Near-linear would be 4x, the bound is tolerant to the noise of processes sharing one SQLite file
+    assert multi_time < single_time * 0.75
+
+    session = multi_db._Session()
+    source_links = [podcast_file.source_link for podcast_file in session.query(PodcastFiles).all()]
+    session.close()
+
+    # Two new episodes in each feed, each one uploaded exactly once
+    assert len(source_links) == feeds_count * 2
+    assert len(set(source_links)) == len(source_links)
+
+
+def test_feed_health(db_uri):
+    db = _add_feeds(db_uri, 'http://localhost', 1)
+    rss_id = db.fetch_all_rss()[0].id
+    assert db.fetch_feed_health(rss_id) is None
+
+    next_probe = datetime.utcnow() + timedelta(hours=1)
+    assert db.record_feed_failure(rss_id, 'timed out', None) == 1
+    assert db.record_feed_failure(rss_id, 'got status 503', next_probe) == 2
+    health = db.fetch_feed_health(rss_id)
+    assert (health.consecutive_failures, health.last_error, health.next_probe) == (2, 'got status 503', next_probe)
+
+    db.record_feed_success(rss_id, 1.0)
+    db.record_feed_success(rss_id, 2.0)
+    health = db.fetch_feed_health(rss_id)
+    assert (health.consecutive_failures, health.next_probe) == (0, None)
+    assert 1.0 < health.average_latency < 2.0
+
+
+def test_subscriptions(db_uri, tmp_path, monkeypatch):
+    _add_feeds(db_uri, 'http://localhost', 3)
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('temporary')
+    with open('temporary/subscribers.txt', 'w', encoding='utf-8') as f:
+        f.write('all@test.com -- all\n'
+                'some@test.com -- some -- http://localhost/feed/0.rss, http://localhost/feed/2.rss\n')
+    db = DatabaseManager(db_uri)
+    subscriber_ids = {subscriber.email: subscriber.id for subscriber in db.fetch_subscribers()}
+    rss_ids = {rss.rss_link: rss.id for rss in db.fetch_all_rss()}
+    assert db.fetch_subscriptions() == {subscriber_ids['some@test.com']: {rss_ids['http://localhost/feed/0.rss'],
+                                                                          rss_ids['http://localhost/feed/2.rss']}}
+
+    # The selected shows of an existing subscriber are replaced
+    with open('temporary/subscribers.txt', 'w', encoding='utf-8') as f:
+        f.write('some@test.com -- some -- http://localhost/feed/1.rss\n')
+    db = DatabaseManager(db_uri)
+    assert db.fetch_subscriptions() == {subscriber_ids['some@test.com']: {rss_ids['http://localhost/feed/1.rss']}}
+
+    # Unknown rss links are skipped, and without any known link the selected shows are kept
+    with open('temporary/subscribers.txt', 'w', encoding='utf-8') as f:
+        f.write('some@test.com -- some -- http://localhost/feed/0.rss, http://localhost/unknown.rss\n'
+                'all@test.com -- all -- http://localhost/unknown.rss\n')
+    db = DatabaseManager(db_uri)
+    assert db.fetch_subscriptions() == {subscriber_ids['some@test.com']: {rss_ids['http://localhost/feed/0.rss']}}
+
+    # A new subscriber without any known show is not added, instead of getting all the shows
+    with open('temporary/subscribers.txt', 'w', encoding='utf-8') as f:
+        f.write('new@test.com -- new -- http://localhost/unknown.rss\n')
+    db = DatabaseManager(db_uri)
+    assert 'new@test.com' not in {subscriber.email for subscriber in db.fetch_subscribers()}
+
+
+def test_saved_bytes(db_uri):
+    db = _add_feeds(db_uri, 'http://localhost', 2)
+    rss_ids = [rss.id for rss in db.fetch_all_rss()]
+    db.insert_podcast_file(rss_ids[0], 'drive', 'link-1', 'episode 1', '', 700, 1, datetime(2024, 1, 1), 1000)
+    podcast_file = db.insert_podcast_file(rss_ids[0], 'drive', 'link-2', 'episode 2', '', 900, 1,
+                                          datetime(2024, 1, 1), 1000)
+    db.insert_podcast_file(rss_ids[1], 'drive', 'link-3', 'episode 3', '', 500, 1, datetime(2024, 1, 1))
+    assert db.fetch_saved_bytes() == [('feed 0', 2000, 1600, 2)]
+
+    # Only the files of one run
+    assert db.fetch_saved_bytes([podcast_file.id]) == [('feed 0', 1000, 900, 1)]
+
+
+def test_rewind_rss(db_uri):
+    db = _add_feeds(db_uri, 'http://localhost', 1)
+    rss_id = db.fetch_all_rss()[0].id
+    db.update_rss(rss_id, '"etag"', 'episode-0', datetime(2024, 1, 1))
+    db.rewind_rss(rss_id)
+    rss = db.fetch_rss(rss_id)
+    assert (rss.e_tag, rss.last_newz_id) == ('', '')
+
+
+def test_add_missing_columns(db_uri, monkeypatch):
+    # A database created before the original_size column
+    engine = create_engine(db_uri)
+    with engine.begin() as connection:
+        connection.execute(text('CREATE TABLE podcast_files (id INTEGER PRIMARY KEY, podcast_id INTEGER, '
+                                'drive_link VARCHAR, source_link VARCHAR, name VARCHAR, description VARCHAR, '
+                                'size VARCHAR, duration INTEGER, published_date DATETIME, is_sent INTEGER)'))
+    db = DatabaseManager(db_uri)
+    assert not db.podcast_file_exists('link-1')
+    assert 'original_size' in {column['name'] for column in inspect(engine).get_columns('podcast_files')}
+
+    # A column added by another worker after the columns were checked
+    inspectors = [SimpleNamespace(get_columns=lambda table_name: [])]
+    monkeypatch.setattr(db_manager, 'inspect', lambda engine: inspectors.pop() if inspectors else inspect(engine))
+    db_manager._add_missing_columns(engine)
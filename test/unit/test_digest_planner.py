@@ -0,0 +1,18 @@
+from types import SimpleNamespace
+from digest_planner import plan_digests
+
+
+def test_plan_digests_by_show_sets():
+    new_podcast = [SimpleNamespace(id=i, podcast_id=i % 3) for i in range(9)]
+
+    # Show 3 has no new episodes, so {0, 3} gets the same digest as {0}
+    show_sets = [{0}, {0, 3}, {1, 2}, {3}, None]
+    subscribers = [SimpleNamespace(id=i, email=f'{i}@test.com') for i in range(1000)]
+    subscriptions = {subscriber.id: show_sets[subscriber.id % 5] for subscriber in subscribers
+                     if show_sets[subscriber.id % 5] is not None}
+    db = SimpleNamespace(fetch_subscribers=lambda: subscribers, fetch_subscriptions=lambda: subscriptions)
+
+    digests = plan_digests(db, new_podcast)
+    assert [([podcast.id for podcast in digest.podcast], len(digest.recipients)) for digest in digests] == \
+           [([0, 3, 6], 400), ([1, 2, 4, 5, 7, 8], 200), (list(range(9)), 200)]
+    assert digests[1].recipients[:2] == ['2@test.com', '7@test.com']
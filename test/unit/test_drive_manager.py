@@ -0,0 +1,262 @@
+import json
+import re
+import httplib2
+import pytest
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from types import SimpleNamespace
+from urllib.parse import urlparse, parse_qs
+from google.auth.credentials import AnonymousCredentials
+import drive_manager
+from drive_manager import DriveManager, DriveAccountExhausted
+from googleapiclient.errors import HttpError
+
+
+@pytest.fixture
+def drive(tmp_path, monkeypatch):
+    free_space = {'a.json': 1000, 'b.json': 3000, 'c.json': 100}
+    for cred_name in free_space:
+        (tmp_path / cred_name).write_text('{}')
+    monkeypatch.setattr(DriveManager, '_get_drive_free_space',
+                        staticmethod(lambda account: free_space[account.cred_path.split('/')[-1]]))
+    monkeypatch.setattr(drive_manager, 'sleep', lambda seconds: None)
+    return DriveManager(str(tmp_path), qps=1000)
+
+
+def _http_error(status: int, reason: str = '') -> HttpError:
+    content = json.dumps({'error': {'errors': [{'reason': reason}]}}).encode()
+    return HttpError(httplib2.Response({'status': status}), content)
+
+
+def test_chunk_size():
+    assert drive_manager._chunk_size(1024) == drive_manager.MIN_CHUNK_SIZE
+    assert drive_manager._chunk_size(100 * 1024 ** 2) == 25 * 1024 ** 2
+    assert drive_manager._chunk_size(1024 ** 3) == drive_manager.MAX_CHUNK_SIZE
+    assert drive_manager._chunk_size(50 * 1024 ** 2 + 1) % drive_manager.CHUNK_UNIT == 0
+
+
+def test_reserve_balance(drive):
+    # The first upload goes to the account with most free space, the next ones to the least loaded accounts
+    accounts = [drive._reserve(500, []) for _ in range(3)]
+    assert [account.cred_path.split('/')[-1] for account in accounts] == ['b.json', 'a.json', 'b.json']
+
+    # No account has free space for a big file
+    assert drive._reserve(2500, []) is None
+
+    drive._release(accounts[0], 500, uploaded=False)
+    assert accounts[0].free_space == 2500 and accounts[0].in_flight == 1
+
+
+def test_execute_retry(drive):
+    account = drive._reserve(10, [])
+    responses = [_http_error(429), _http_error(403, 'userRateLimitExceeded'), _http_error(503), 'done']
+
+    def request():
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    assert drive._execute(account, request) == 'done'
+
+    with pytest.raises(HttpError):
+        drive._execute(account, lambda: (_ for _ in ()).throw(_http_error(404)))
+
+    with pytest.raises(DriveAccountExhausted):
+        drive._execute(account, lambda: (_ for _ in ()).throw(_http_error(403, 'storageQuotaExceeded')))
+
+
+def test_upload_failover(drive, tmp_path, monkeypatch):
+    file_path = tmp_path / 'episode.mp3'
+    file_path.write_bytes(b'0' * 500)
+    used_accounts = []
+
+    def upload_with_account(account, *args):
+        used_accounts.append(account.cred_path.split('/')[-1])
+        if len(used_accounts) == 1:
+            raise DriveAccountExhausted(account.cred_path)
+        return 'drive link'
+
+    monkeypatch.setattr(drive, '_upload_with_account', upload_with_account)
+    assert drive.upload(str(file_path), 'episode.mp3', 'audio/mpeg', '') == 'drive link'
+    assert used_accounts == ['b.json', 'a.json']
+    assert all(account.in_flight == 0 for account in drive._accounts)
+    assert [account.cred_path.split('/')[-1] for account in drive._accounts if account.exhausted] == ['b.json']
+
+
+class FakeDriveHandler(BaseHTTPRequestHandler):
+    """
+    Minimal Drive v3 API: about, files list/create/delete, resumable uploads and batched permissions.
+    The first permission of each batch fails once with 503 to check the batch retry,
+    the permissions of the files named private always fail with 403.
+    """
+    drive = None
+
+    def _send_json(self, data: dict, status: int = 200, headers: dict = None):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def do_GET(self):
+        self.drive['requests'].append(('GET', self.path))
+        url = urlparse(self.path)
+        if url.path == '/drive/v3/about':
+            self._send_json({'storageQuota': {'limit': '10000000', 'usage': '0'}})
+        elif url.path == '/drive/v3/files':
+            name = re.search(r"name='(.*?)'", parse_qs(url.query)['q'][0]).group(1)
+            folders = [{'id': file_id} for file_id, file in self.drive['files'].items()
+                       if file['name'] == name and file.get('mimeType') == drive_manager.FOLDER_MIME_TYPE]
+            self._send_json({'files': folders})
+
+    def do_POST(self):
+        self.drive['requests'].append(('POST', self.path))
+        url = urlparse(self.path)
+        body = self._read_body()
+        if url.path == '/drive/v3/files':
+            file_id = f'file-{len(self.drive["files"])}'
+            self.drive['files'][file_id] = dict(json.loads(body), permissions=[])
+            self._send_json({'id': file_id})
+        elif url.path == '/upload/drive/v3/files':
+            session_id = str(len(self.drive['sessions']))
+            self.drive['sessions'][session_id] = {'metadata': json.loads(body), 'data': b''}
+            self._send_json({}, headers={'Location': f'http://{self.headers["Host"]}/upload/session/{session_id}'})
+        elif url.path == '/batch/drive/v3':
+            self._batch(body)
+
+    def do_DELETE(self):
+        self.drive['requests'].append(('DELETE', self.path))
+        del self.drive['files'][urlparse(self.path).path.split('/')[-1]]
+        self.send_response(204)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_PUT(self):
+        self.drive['requests'].append(('PUT', self.path))
+        session = self.drive['sessions'][self.path.split('/')[-1]]
+        session['data'] += self._read_body()
+        total = int(self.headers['Content-Range'].split('/')[-1])
+        if len(session['data']) < total:
+            self.send_response(308)
+            self.send_header('Range', f'bytes=0-{len(session["data"]) - 1}')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        file_id = f'file-{len(self.drive["files"])}'
+        self.drive['files'][file_id] = dict(session['metadata'], size=total, permissions=[])
+        self._send_json({'id': file_id})
+
+    def _batch(self, body: bytes):
+        message = BytesParser().parsebytes(f'Content-Type: {self.headers["Content-Type"]}\r\n\r\n'.encode() + body)
+        boundary = 'batch_boundary'
+        response = ''
+        for i, part in enumerate(message.get_payload()):
+            request_line, request_body = re.split(r'\r?\n\r?\n', part.get_payload(), maxsplit=1)
+            file_id = request_line.split()[1].split('/')[4]
+            if self.drive['files'][file_id]['name'].startswith('private'):
+                status, content = '403 Forbidden', {'error': {'errors': [{'reason': 'forbidden'}]}}
+            elif i == 0 and file_id not in self.drive['failed_permissions']:
+                self.drive['failed_permissions'].add(file_id)
+                status, content = '503 Service Unavailable', {'error': {'errors': [{'reason': 'backendError'}]}}
+            else:
+                self.drive['files'][file_id]['permissions'].append(json.loads(request_body))
+                status, content = '200 OK', {'id': 'anyoneWithLink'}
+            response += (f'--{boundary}\r\nContent-Type: application/http\r\n'
+                         f'Content-ID: <response-{part["Content-ID"][1:]}\r\n\r\n'
+                         f'HTTP/1.1 {status}\r\nContent-Type: application/json\r\n\r\n{json.dumps(content)}\r\n')
+        response = (response + f'--{boundary}--\r\n').encode()
+        self.send_response(200)
+        self.send_header('Content-Type', f'multipart/mixed; boundary={boundary}')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def fake_drive(tmp_path, monkeypatch):
+    state = {'files': {}, 'sessions': {}, 'requests': [], 'failed_permissions': set()}
+    handler = type('Handler', (FakeDriveHandler,), {'drive': state})
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    Thread(target=server.serve_forever, daemon=True).start()
+
+    for cred_name in ('a.json', 'b.json'):
+        (tmp_path / cred_name).write_text('{}')
+    monkeypatch.setattr(drive_manager, 'DRIVE_API_ENDPOINT', f'http://127.0.0.1:{server.server_port}/drive/v3/')
+    monkeypatch.setattr(drive_manager.DriveAccount, '_credentials', lambda account: AnonymousCredentials())
+    monkeypatch.setattr(drive_manager, 'sleep', lambda seconds: None)
+    yield DriveManager(str(tmp_path), qps=1000), state
+    server.shutdown()
+
+
+def test_upload_batched_calls(fake_drive, tmp_path):
+    drive, state = fake_drive
+    shows = ['show a', "show's b", 'show a', "show's b", 'show a']
+    links = []
+    for i, show in enumerate(shows):
+        file_path = tmp_path / f'episode-{i}.mp3'
+        file_path.write_bytes(b'0' * 1000)
+        links.append(drive.upload(str(file_path), f'episode {i}.mp3', 'audio/mpeg', f'description {i}', show))
+    assert sorted(drive.flush()) == sorted(links)
+    assert drive.flush() == []
+
+    episodes = {file['name']: file for file in state['files'].values() if file['name'].startswith('episode')}
+    folders = {file_id: file['name'] for file_id, file in state['files'].items()
+               if file.get('mimeType') == drive_manager.FOLDER_MIME_TYPE}
+    assert len(episodes) == 5
+    for i, show in enumerate(shows):
+        episode = episodes[f'episode {i}.mp3']
+        assert episode['description'] == f'description {i}'
+        assert episode['permissions'] == [drive_manager.PUBLIC_PERMISSION]
+        assert [folders[folder_id] for folder_id in episode['parents']] == [show]
+
+    # No separate permission call for each file, only batches: one for each account and one retry for each
+    assert not [path for method, path in state['requests'] if 'permissions' in path]
+    assert len([path for method, path in state['requests'] if path == '/batch/drive/v3']) == 4
+
+    # The counted round-trips are the requests the server received
+    report = drive.report()
+    assert report['round_trips'] == len(state['requests'])
+    assert report['files'] == 5
+    assert report['round_trips_per_file'] == len(state['requests']) / 5
+
+
+def test_only_shared_files_returned(fake_drive, tmp_path):
+    drive, state = fake_drive
+    links = []
+    for name in ('episode.mp3', 'private.mp3'):
+        file_path = tmp_path / name
+        file_path.write_bytes(b'0' * 1000)
+        links.append(drive.upload(str(file_path), name, 'audio/mpeg', '', 'show'))
+    assert drive.flush() == [links[0]]
+    assert drive.flush() == []
+
+    drive.delete([links[1]])
+    assert not [file for file in state['files'].values() if file['name'] == 'private.mp3']
+
+
+def test_flush_continues_past_failed_account(fake_drive, tmp_path, monkeypatch):
+    drive, state = fake_drive
+    links = []
+    for i in range(2):
+        file_path = tmp_path / f'episode-{i}.mp3'
+        file_path.write_bytes(b'0' * 1000)
+        links.append(drive.upload(str(file_path), f'episode {i}.mp3', 'audio/mpeg', '', 'show'))
+
+    # The uploads are spread over both accounts, the batch request of the first account fails
+    failed_account = drive._accounts[0]
+    failed_link = f'https://drive.google.com/file/d/{failed_account.pending_permissions[0]}/view'
+    monkeypatch.setattr(failed_account, 'new_batch',
+                        lambda callback: SimpleNamespace(add=lambda *args, **kwargs: None,
+                                                         execute=lambda: (_ for _ in ()).throw(_http_error(400))))
+    assert drive.flush() == [link for link in links if link != failed_link]
@@ -0,0 +1,77 @@
+from datetime import datetime
+from types import SimpleNamespace
+import files_manager
+from files_manager import FilesManager
+from get_new_podcast import Podcast
+
+
+class FakeDatabase:
+    def __init__(self):
+        self.podcast_files = []
+        self.rewound_rss = []
+        self.leases = set()
+
+    def podcast_file_exists(self, source_link):
+        return False
+
+    def fetch_rss(self, rss_id):
+        return SimpleNamespace(title=f'show {rss_id}')
+
+    def acquire_lease(self, resource, owner, ttl):
+        self.leases.add(resource)
+        return True
+
+    def release_lease(self, resource, owner):
+        self.leases.remove(resource)
+
+    def insert_podcast_file(self, podcast_id, drive_link, source_link, *args):
+        self.podcast_files.append((podcast_id, drive_link, source_link))
+        return SimpleNamespace(id=len(self.podcast_files))
+
+    def rewind_rss(self, rss_id):
+        self.rewound_rss.append(rss_id)
+
+
+class FakeDrive:
+    """
+    Drive that shares all the files except the private ones, only when flushed
+    """
+    def __init__(self):
+        self.uploaded = []
+        self.deleted = []
+
+    def upload(self, file_path, file_name, mime_type, description, folder_name=None):
+        self.uploaded.append(f'link/{file_name}')
+        return self.uploaded[-1]
+
+    def flush(self):
+        return [link for link in self.uploaded if 'private' not in link]
+
+    def delete(self, drive_links):
+        self.deleted += drive_links
+
+    def report(self):
+        pass
+
+
+def test_only_shared_files_stored(tmp_path, monkeypatch):
+    def download(self, file_url, file_name):
+        file_path = tmp_path / file_name
+        file_path.write_bytes(b'0' * 1000)
+        return str(file_path), 1000
+
+    monkeypatch.setattr(FilesManager, '_download_podcast', download)
+    monkeypatch.setattr(FilesManager, '_get_duration', staticmethod(lambda file_path: 60))
+    monkeypatch.setattr('create_email_message.cache_podcast_fragment', lambda podcast_file: '')
+    podcast_list = [Podcast(1, 'episode', 'https://example.com/episode.mp3', '', datetime(2024, 1, 1)),
+                    Podcast(2, 'private', 'https://example.com/private.mp3', '', datetime(2024, 1, 1))]
+    db = FakeDatabase()
+    manager = FilesManager(podcast_list, db, transfer_workers=2)
+    manager._drive = FakeDrive()
+    manager.get_all_podcast()
+
+    # The private file is deleted and its feed is read again by the next run
+    assert db.podcast_files == [(1, 'link/episode.mp3', 'https://example.com/episode.mp3')]
+    assert manager._drive.deleted == ['link/private.mp3']
+    assert db.rewound_rss == [2]
+    assert db.leases == set()
@@ -1,7 +1,11 @@
 import os
+import time
 import feedparser
 import get_new_podcast
 import pytest
+from datetime import date, datetime
+from itertools import islice
+from types import SimpleNamespace
 
 
 @pytest.fixture
@@ -22,3 +26,162 @@ def test_get_mp3_link(get_feed_parser_entry):
                '04108/d079955c-6fc3-4ea4-ae0d-b0c1015e7da6/audio.mp3?utm_source=Podcast&in_playlist=0ab18f' \
                '83-1327-4f4e-9d7a-ace100c0411f'
     assert result == mp3_link
+
+
+def test_stream_feed_stop_at_known_entry(rss_server):
+    rss_url = f'{rss_server}/big.rss'
+    etag, entries = get_new_podcast._stream_feed(rss_url, '', 'episode-3', date(2000, 1, 1))
+    assert etag == '"test-etag"'
+    assert [entry.entry_id for entry in entries] == ['episode-0', 'episode-1', 'episode-2', 'episode-3']
+
+    # The streaming entries should be the same as the entries parsed by feedparser
+    _, feedparser_entries = get_new_podcast._parse_feed(rss_url, '')
+    assert entries == list(islice(feedparser_entries, 4))
+
+
+def test_stream_feed_stop_at_last_date(rss_server):
+    _, entries = get_new_podcast._stream_feed(f'{rss_server}/big.rss', '', '', date(2023, 12, 30))
+    assert [entry.entry_id for entry in entries] == ['episode-0', 'episode-1', 'episode-2', 'episode-3']
+
+
+def test_stream_feed_malformed_fallback(rss_server):
+    assert get_new_podcast._stream_feed(f'{rss_server}/broken.rss', '', '', date(2000, 1, 1)) is None
+
+
+def test_stream_feed_benchmark(rss_server):
+    rss_url = f'{rss_server}/big.rss'
+    start_time = time.perf_counter()
+    _, entries = get_new_podcast._stream_feed(rss_url, '', 'episode-5', date(2000, 1, 1))
+    stream_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    _, feedparser_entries = get_new_podcast._parse_feed(rss_url, '')
+    feedparser_entries = list(islice(feedparser_entries, 6))
+    feedparser_time = time.perf_counter() - start_time
+
+    # The times are only reported, a loaded host makes a timing assertion flaky
+    print(f'\n5000 items feed: streaming {stream_time * 1000:.1f} ms, feedparser {feedparser_time * 1000:.1f} ms')
+    assert entries == feedparser_entries
+
+
+class FakeDatabase:
+    def __init__(self, all_rss):
+        self.all_rss = all_rss
+        self.updated_rss = []
+        self.health = {}
+
+    def fetch_all_rss(self):
+        return self.all_rss
+
+    def fetch_rss(self, rss_id):
+        return next(rss for rss in self.all_rss if rss.id == rss_id)
+
+    def acquire_lease(self, resource, owner, ttl):
+        return True
+
+    def release_lease(self, resource, owner):
+        pass
+
+    def update_rss(self, rss_id, etag, last_newz_id=None, new_date=None):
+        self.updated_rss.append((rss_id, etag, last_newz_id))
+
+    def fetch_feed_health(self, rss_id):
+        return self.health.get(rss_id)
+
+    def record_feed_success(self, rss_id, latency):
+        self.health[rss_id] = SimpleNamespace(consecutive_failures=0, next_probe=None)
+
+    def record_feed_failure(self, rss_id, error, next_probe):
+        failures = self.health.get(rss_id, SimpleNamespace(consecutive_failures=0)).consecutive_failures + 1
+        self.health[rss_id] = SimpleNamespace(consecutive_failures=failures, next_probe=next_probe, last_error=error)
+        return failures
+
+
+def test_get_all_new_podcast_is_lazy(rss_server):
+    all_rss = [SimpleNamespace(id=rss_id, rss_link=f'{rss_server}/big.rss', e_tag='', last_newz_id='episode-2')
+               for rss_id in (1, 2)]
+    db = FakeDatabase(all_rss)
+    new_podcast = get_new_podcast.get_all_new_podcast(db, date(2000, 1, 1))
+
+    first_podcast = next(new_podcast)
+    assert first_podcast == get_new_podcast.Podcast(1, 'episode 0', 'https://example.com/episode-0.mp3',
+                                                    '<p>description of episode 0</p>', datetime(2024, 1, 1, 12))
+    assert db.updated_rss == []
+
+    remain_podcast = list(new_podcast)
+    assert [(podcast.podcast_id, podcast.name) for podcast in remain_podcast] == \
+           [(1, 'episode 1'), (2, 'episode 0'), (2, 'episode 1')]
+    assert db.updated_rss == [(1, '"test-etag"', 'episode-0'), (2, '"test-etag"', 'episode-0')]
+
+
+def test_prefetch_new_podcast():
+    assert list(get_new_podcast.prefetch_new_podcast(iter(range(20)), max_pending=2)) == list(range(20))
+
+    def failed_discovery():
+        yield 1
+        raise ValueError('discovery failed')
+
+    prefetch = get_new_podcast.prefetch_new_podcast(failed_discovery())
+    assert next(prefetch) == 1
+    with pytest.raises(ValueError):
+        next(prefetch)
+
+    def exited_discovery():
+        yield 1
+        raise SystemExit(1)
+
+    prefetch = get_new_podcast.prefetch_new_podcast(exited_discovery())
+    assert next(prefetch) == 1
+    with pytest.raises(SystemExit):
+        next(prefetch)
+
+
+def test_feed_timeout(rss_server, monkeypatch):
+    monkeypatch.setattr(get_new_podcast, 'FEED_TIMEOUT', 0.5)
+    start_time = time.perf_counter()
+    with pytest.raises(TimeoutError):
+        get_new_podcast._stream_feed(f'{rss_server}/slow.rss', '', '', date(2000, 1, 1))
+    with pytest.raises(TimeoutError):
+        get_new_podcast._parse_feed(f'{rss_server}/slow.rss', '')
+    assert time.perf_counter() - start_time < 3
+
+
+def test_unhealthy_feed_skipped(rss_server):
+    all_rss = [SimpleNamespace(id=1, rss_link=f'{rss_server}/error.rss', e_tag='', last_newz_id=''),
+               SimpleNamespace(id=2, rss_link=f'{rss_server}/feed/healthy.rss', e_tag='', last_newz_id='episode-1')]
+    db = FakeDatabase(all_rss)
+
+    for run in range(get_new_podcast.FEED_FAILURE_THRESHOLD):
+        assert [podcast.podcast_id for podcast in get_new_podcast.get_all_new_podcast(db, date(2000, 1, 1))] == [2]
+        assert db.health[1].consecutive_failures == run + 1
+        assert db.health[2].consecutive_failures == 0
+    assert db.health[1].next_probe > datetime.utcnow()
+    assert '503' in db.health[1].last_error
+
+    # The open circuit skips the feed without fetching it
+    list(get_new_podcast.get_all_new_podcast(db, date(2000, 1, 1)))
+    assert db.health[1].consecutive_failures == get_new_podcast.FEED_FAILURE_THRESHOLD
+
+    # The probe interval doubles with each failed probe
+    first_interval = get_new_podcast._next_probe(get_new_podcast.FEED_FAILURE_THRESHOLD) - datetime.utcnow()
+    second_interval = get_new_podcast._next_probe(get_new_podcast.FEED_FAILURE_THRESHOLD + 1) - datetime.utcnow()
+    assert round(second_interval / first_interval) == 2
+
+
+def test_malformed_entry_skipped(rss_server):
+    all_rss = [SimpleNamespace(id=1, rss_link=f'{rss_server}/nodate.rss', e_tag='', last_newz_id='')]
+    db = FakeDatabase(all_rss)
+
+    # The undated entry is skipped, the feed is healthy and advanced past the good entries
+    new_podcast = list(get_new_podcast.get_all_new_podcast(db, date(2000, 1, 1)))
+    assert [podcast.name for podcast in new_podcast] == ['episode 0', 'episode 2']
+    assert db.health[1].consecutive_failures == 0
+    assert db.updated_rss == [(1, '"test-etag"', 'episode-0')]
+
+
+def test_run_deadline_stops_discovery(rss_server):
+    all_rss = [SimpleNamespace(id=1, rss_link=f'{rss_server}/feed/1.rss', e_tag='', last_newz_id='episode-1')]
+    db = FakeDatabase(all_rss)
+    deadline = SimpleNamespace(expired=lambda: True)
+    assert list(get_new_podcast.get_all_new_podcast(db, date(2000, 1, 1), deadline=deadline)) == []
+    assert db.health == {}
@@ -0,0 +1,82 @@
+import os
+from io import BytesIO
+import eyed3
+import pytest
+from id3_stripper import ID3Stripper, _to_syncsafe, _to_frame_size
+
+AUDIO = b''.join(b'\xff\xfb\x90\x64' + bytes(413) for _ in range(100))
+
+
+def _frame(frame_id: bytes, body: bytes, version: int) -> bytes:
+    return frame_id + _to_frame_size(len(body), version) + b'\0\0' + body
+
+
+def _picture(description: str, size: int, version: int) -> bytes:
+    return _frame(b'APIC', b'\0image/jpeg\0\x03' + description.encode() + b'\0' + os.urandom(size), version)
+
+
+def _mp3(version: int, padding: int) -> bytes:
+    """
+    MP3 file with a title, a big and a small cover, a chapter with a title and a big picture,
+    and a table of contents with a title and a big picture
+    """
+    chapter = b'ch1\0' + (0).to_bytes(4, 'big') + (1000).to_bytes(4, 'big') + b'\xff' * 8 + \
+        _frame(b'TIT2', b'\0chapter', version) + _picture('chapter image', 500_000, version)
+    toc = b'toc\0' + b'\x03' + b'\x01' + b'ch1\0' + \
+        _frame(b'TIT2', b'\0contents', version) + _picture('toc image', 500_000, version)
+    frames = _frame(b'TIT2', b'\0episode', version) + _picture('big', 2_000_000, version) + \
+        _picture('small', 1000, version) + _frame(b'CHAP', chapter, version) + _frame(b'CTOC', toc, version)
+    return b'ID3' + bytes([version, 0, 0]) + _to_syncsafe(len(frames) + padding) + frames + bytes(padding) + AUDIO
+
+
+def _strip(data: bytes, chunk_size: int) -> tuple[bytes, ID3Stripper]:
+    output = BytesIO()
+    stripper = ID3Stripper(output, max_picture_bytes=64 * 1024)
+    for i in range(0, len(data), chunk_size):
+        stripper.write(data[i:i + chunk_size])
+    stripper.close()
+    return output.getvalue(), stripper
+
+
+@pytest.mark.parametrize('version', [3, 4])
+def test_strip_pictures_and_padding(version, tmp_path):
+    data = _mp3(version, padding=100_000)
+    stripped, stripper = _strip(data, 64 * 1024)
+    assert (stripper.original_size, stripper.size) == (len(data), len(stripped))
+    assert len(stripped) < len(AUDIO) + 2000
+    assert stripped.endswith(AUDIO)
+
+    # The tag is still valid, only the big pictures are dropped
+    (tmp_path / 'episode.mp3').write_bytes(stripped)
+    tag = eyed3.load(tmp_path / 'episode.mp3').tag
+    assert tag.title == 'episode'
+    assert [image.description for image in tag.images] == ['small']
+    chapter = tag.chapters.get(b'ch1')
+    assert chapter.title == 'chapter'
+    assert b'APIC' not in chapter.sub_frames
+    toc = tag.table_of_contents.get(b'toc')
+    assert toc.child_ids == [b'ch1'] and toc.description == 'contents'
+
+
+def test_bounded_memory():
+    # The big pictures, also inside the chapter and the table of contents, are never held in memory
+    data = _mp3(4, padding=1000)
+    stripper = ID3Stripper(BytesIO(), max_picture_bytes=64 * 1024)
+    held_bytes = 0
+    for i in range(0, len(data), 16 * 1024):
+        stripper.write(data[i:i + 16 * 1024])
+        held_bytes = max(held_bytes, len(stripper._buffer) + len(stripper._container_body) + len(stripper._frames))
+    stripper.close()
+    assert held_bytes < 100 * 1024
+
+
+def test_strip_any_chunk_size():
+    data = _mp3(3, padding=1000)
+    expected, _ = _strip(data, len(data))
+    for chunk_size in (1, 7, 10, 4096):
+        assert _strip(data, chunk_size)[0] == expected
+
+
+def test_no_tag_untouched():
+    assert _strip(AUDIO, 100)[0] == AUDIO
+    assert _strip(b'ID3', 100)[0] == b'ID3'
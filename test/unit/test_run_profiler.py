@@ -0,0 +1,90 @@
+import pstats
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Timer
+import run_profiler
+
+
+def _cpu_work(seconds: float) -> int:
+    end_time = time.perf_counter() + seconds
+    count = 0
+    while time.perf_counter() < end_time:
+        count += sum(range(100))
+    return count
+
+
+def _network_work(seconds: float) -> bytes:
+    reader, writer = socket.socketpair()
+    with reader, writer:
+        Timer(seconds, writer.sendall, [b'x']).start()
+        return reader.makefile('rb').read(1)
+
+
+def _render(count: int):
+    for i in range(count):
+        _cpu_work(0.1)
+        yield i
+
+
+def test_run_profiler(tmp_path):
+    profiler = run_profiler.start(str(tmp_path / 'profile'))
+    try:
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            with run_profiler.stage('transfer'):
+                futures = [executor.submit(run_profiler.profiled('transfer', _network_work), 0.5) for _ in range(2)]
+                assert [future.result() for future in futures] == [b'x', b'x']
+
+        with run_profiler.stage('send'):
+            assert list(run_profiler.profiled_iter('render', _render(3))) == [0, 1, 2]
+            _cpu_work(0.3)
+    finally:
+        run_profiler.stop()
+
+    output_files = sorted(path.name for path in (tmp_path / 'profile').iterdir())
+    assert output_files == ['breakdown.txt', 'render-allocations.txt', 'render.prof', 'send-allocations.txt',
+                            'send.prof', 'transfer-allocations.txt', 'transfer.prof']
+
+    # The nested render stage is profiled apart from the send stage around it
+    render_functions = {function for _, _, function in pstats.Stats(str(tmp_path / 'profile/render.prof')).stats}
+    send_functions = {function for _, _, function in pstats.Stats(str(tmp_path / 'profile/send.prof')).stats}
+    assert '_render' in render_functions and '_render' not in send_functions
+    assert '_network_work' in {function for _, _, function in
+                               pstats.Stats(str(tmp_path / 'profile/transfer.prof')).stats}
+
+    # The transfer threads wait for the network, the render and send stages use the CPU
+    samples = {name: stage.samples for name, stage in profiler._stages.items()}
+    assert samples['transfer'][run_profiler.NETWORK_WAIT] > 0.5
+    assert samples['transfer'][run_profiler.CPU] < 0.2
+    assert samples['render'][run_profiler.CPU] > 0.15
+    assert samples['send'][run_profiler.CPU] > 0.15
+    assert 'transfer: wall' in (tmp_path / 'profile/breakdown.txt').read_text()
+
+
+def test_profiling_disabled():
+    def work():
+        return 1
+    assert run_profiler.profiled('transfer', work) is work
+    iterator = iter([1])
+    assert run_profiler.profiled_iter('render', iterator) is iterator
+    with run_profiler.stage('send'):
+        pass
+
+
+def test_run_profile(tmp_path, monkeypatch):
+    # Python 3.12+ allows one enabled cProfile at a time, the threads of the stages don't enable their own
+    monkeypatch.setattr(run_profiler, '_profiler', run_profiler.RunProfiler(str(tmp_path / 'profile'),
+                                                                           profile_each_stage=False))
+    run_profiler._profiler.start()
+    try:
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            with run_profiler.stage('transfer'):
+                futures = [executor.submit(run_profiler.profiled('transfer', _cpu_work), 0.2) for _ in range(2)]
+                assert all(future.result() for future in futures)
+                _cpu_work(0.1)
+    finally:
+        run_profiler.stop()
+
+    output_files = sorted(path.name for path in (tmp_path / 'profile').iterdir())
+    assert output_files == ['breakdown.txt', 'run.prof', 'transfer-allocations.txt']
+    assert '_cpu_work' in {function for _, _, function in pstats.Stats(str(tmp_path / 'profile/run.prof')).stats}
@@ -0,0 +1,121 @@
+import smtplib
+import socketserver
+import sys
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from io import BytesIO
+from threading import Thread
+from types import SimpleNamespace
+import pytest
+import send_email
+from create_email_message import write_message
+from digest_planner import Digest
+
+
+class FakeSMTPHandler(socketserver.StreamRequestHandler):
+    """
+    Minimal SMTP server, stores the received messages with their recipients
+    and rejects the messages that contain 'reject me'.
+    """
+    messages = None
+    recipients = None
+
+    def _reply(self, line: str):
+        self.wfile.write(f'{line}\r\n'.encode())
+
+    def handle(self):
+        self._reply('220 fake smtp')
+        message_recipients = []
+        while line := self.rfile.readline():
+            command = line.decode().strip().upper()
+            if command.startswith(('EHLO', 'HELO')):
+                self._reply('250 fake')
+            elif command == 'DATA':
+                self._reply('354 go ahead')
+                data = b''
+                while (data_line := self.rfile.readline()) != b'.\r\n':
+                    data += data_line[1:] if data_line.startswith(b'..') else data_line
+                if b'reject me' in data:
+                    self._reply('552 message too big')
+                else:
+                    self.messages.append(data)
+                    self.recipients.append(message_recipients)
+                    self._reply('250 ok')
+                message_recipients = []
+            elif command.startswith('RCPT TO:'):
+                message_recipients.append(line.decode().strip()[len('RCPT TO:'):].strip('<>'))
+                self._reply('250 ok')
+            elif command == 'QUIT':
+                self._reply('221 bye')
+                return
+            else:
+                self._reply('250 ok')
+
+
+@pytest.fixture
+def smtp_server():
+    messages, recipients = [], []
+    handler = type('Handler', (FakeSMTPHandler,), {'messages': messages, 'recipients': recipients})
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+    yield server.server_address, messages, recipients
+    server.shutdown()
+
+
+def _message(text: str) -> MIMEMultipart:
+    message = MIMEMultipart()
+    message.attach(MIMEText(text, 'plain'))
+    return message
+
+
+def test_send_message_stream(smtp_server):
+    address, messages, _ = smtp_server
+    message = _message('first line\n.line with dot\n..two dots\n.')
+    with smtplib.SMTP(*address) as server:
+        assert send_email._send_message(server, 'from@test.com', ['to@test.com'], message) == {}
+
+    expected = BytesIO()
+    write_message(message, expected)
+    assert messages == [expected.getvalue() if expected.getvalue().endswith(b'\r\n')
+                        else expected.getvalue() + b'\r\n']
+
+
+def test_send_email_mark_sent_parts(smtp_server, monkeypatch):
+    address, messages, recipients = smtp_server
+
+    class FakeSMTP(smtplib.SMTP):
+        def __init__(self, host, port, timeout):
+            super().__init__(*address, timeout=timeout)
+
+        def starttls(self, *args, **kwargs):
+            pass
+
+        def login(self, *args, **kwargs):
+            pass
+
+    # Each digest is rendered into one message per episode
+    rendered = []
+
+    def create_mail_messages(new_podcast):
+        rendered.append([podcast.id for podcast in new_podcast])
+        for podcast in new_podcast:
+            yield _message('reject me' if podcast.id == 4 else f'episode {podcast.id}'), [podcast]
+
+    monkeypatch.setattr(send_email, 'create_mail_messages', create_mail_messages)
+    monkeypatch.setattr(send_email.smtplib, 'SMTP', FakeSMTP)
+    monkeypatch.setitem(sys.modules, 'private_conf', SimpleNamespace(
+        private_conf={'sender_email_address': 'from@test.com', 'sender_email_password': ''}))
+    sent_ids = []
+    db = SimpleNamespace(update_sent=sent_ids.append)
+    podcast = {podcast_id: SimpleNamespace(id=podcast_id) for podcast_id in range(1, 5)}
+    digests = [Digest([podcast[1], podcast[2], podcast[3]], ['a@test.com', 'b@test.com', 'c@test.com']),
+               Digest([podcast[3], podcast[4]], ['d@test.com'])]
+
+    assert not send_email.send_email(db, digests, recipients_batch=2)
+    assert rendered == [[1, 2, 3], [3, 4]]
+
+    # Episode 3 is marked as sent only after the second digest sent it
+    assert sent_ids == [1, 2, 3]
+    assert recipients == [['a@test.com', 'b@test.com'], ['c@test.com']] * 3 + [['d@test.com']]
+    assert b'Subject: =?utf-8?' in messages[2]